@@ -1,93 +1,97 @@
-import taichi as ti
+import numpy as np
 import math
+import kernelgen
 
 
-class vec:
-    def __init__(self, x, y):
-        self.x = x
-        self.y = y
+N = 4  # expansion terms, i.e. orders 0 .. N - 1
 
-    def __pos__(a):
-        return vec(a.x, a.y)
 
-    def __neg__(a):
-        return vec(-a.x, -a.y)
+def offsets(order):
+    # terms of total order k live at offsets(order)[k] + j, where j counts
+    # the y factors: (x^k, x^(k-1) y, ..., y^k)
+    return [k * (k + 1) // 2 for k in range(order + 2)]
 
-    def __add__(a, b):
-        return vec(a.x + b.x, a.y + b.y)
-
-    __radd__ = __add__
 
-    def __mul__(a, b):
-        return vec(a.x * b, a.y * b)
+def derivatives(p, order=N - 1):
+    # every derivative of g = x / r up to `order`, laid out by offsets,
+    # shape p.shape[:-1] + (terms, ); kernels come from kernelgen's cache
+    terms = kernelgen.load('x_over_r', order).derivatives_np(p[..., 0],
+                                                             p[..., 1])
+    return np.stack(np.broadcast_arrays(*terms), axis=-1)
 
-    __rmul__ = __mul__
 
-    def __truediv__(a, b):
-        return a * (1 / b)
-
-    def __repr__(self):
-        return f'vec({self.x}, {self.y})'
+class multipoles:
+    '''
+    A batch of expansions: center is (n, 2) and q is (n, terms) holding the
+    raw moments sum q dx^(k-j) dy^j about each center, laid out by offsets.
+    '''
+    def __init__(self, center, q):
+        self.center = np.asarray(center, np.float64)
+        self.q = np.asarray(q, np.float64)
+        self.order = round((math.sqrt(8 * self.q.shape[-1] + 1) - 3) / 2)
 
-    def __getitem__(self, i):
-        if i == 0:
-            return self.x
-        elif i == 1:
-            return self.y
-        else:
-            raise IndexError
+    @classmethod
+    def from_points(cls, pos, charge, center=None, order=N - 1):
+        # P2M: pos is (n, m, 2) and charge (n, m), one expansion per row
+        pos = np.asarray(pos, np.float64)
+        charge = np.asarray(charge, np.float64)
+        if center is None:
+            center = weighted_center(pos, charge)
+        d = pos - center[:, None]
+        q = np.stack([(charge * d[..., 0]**(k - j) * d[..., 1]**j).sum(-1)
+                      for k in range(order + 1) for j in range(k + 1)],
+                     axis=-1)
+        return cls(center, q)
 
     def __len__(self):
-        return 2
-
-
-def pol(p, i):
-    sqrt = math.sqrt
-    x, y = p
-    if i == (0, 0): ret = x/sqrt(x**2 + y**2)
-    elif i == (1, 0): ret = -x**2/(x**2 + y**2)**(3/2) + 1/sqrt(x**2 + y**2)
-    elif i == (1, 1): ret = -x*y/(x**2 + y**2)**(3/2)
-    elif i == (2, 0): ret = 3*x**3/(x**2 + y**2)**(5/2) - 3*x/(x**2 + y**2)**(3/2)
-    elif i == (2, 1): ret = 3*x**2*y/(x**2 + y**2)**(5/2) - y/(x**2 + y**2)**(3/2)
-    elif i == (2, 3): ret = 3*x*y**2/(x**2 + y**2)**(5/2) - x/(x**2 + y**2)**(3/2)
-    elif i == (3, 0): ret = -15*x**4/(x**2 + y**2)**(7/2) + 18*x**2/(x**2 + y**2)**(5/2) - 3/(x**2 + y**2)**(3/2)
-    elif i == (3, 1): ret = -15*x**3*y/(x**2 + y**2)**(7/2) + 9*x*y/(x**2 + y**2)**(5/2)
-    elif i == (3, 2): ret = -15*x**2*y**2/(x**2 + y**2)**(7/2) + 3*x**2/(x**2 + y**2)**(5/2) + 3*y**2/(x**2 + y**2)**(5/2) - 1/(x**2 + y**2)**(3/2)
-    elif i == (3, 3): ret = -15*x*y**3/(x**2 + y**2)**(7/2) + 9*x*y/(x**2 + y**2)**(5/2)
-    else: assert False, i
-    return ret
-
+        return len(self.q)
 
-
-N = 4
-
-class multipole:
-    def __init__(self, center=None, *q):
-        self.center = center
-        self.q = q
+    def __getitem__(self, i):
+        return multipoles(self.center[i], self.q[i])
 
     def __repr__(self):
-        return f'multipole({repr(self.center)}, {", ".join(map(repr, self.q))})'
-
-    def translate(a, k, cent):
-        cent = a.center - cent
-        ret = 0
-        for i in range(N - k - 1):
-            ret += a.q[k - i] * cent ** k
-        return ret
+        return f'multipoles({len(self)} x order {self.order})'
+
+    def translate(a, cent):
+        # M2M: moments about cent, (dx + tx)^a (dy + ty)^b expanded
+        off = offsets(a.order)
+        t = a.center - cent
+        q = np.zeros_like(a.q)
+        for k in range(a.order + 1):
+            for j in range(k + 1):
+                for kk in range(k + 1):
+                    for jj in range(max(0, j - k + kk), min(j, kk) + 1):
+                        ix, iy = kk - jj, jj
+                        q[..., off[k] + j] += (
+                            math.comb(k - j, ix) * math.comb(j, iy) *
+                            t[..., 0]**(k - j - ix) * t[..., 1]**(j - iy) *
+                            a.q[..., off[kk] + jj])
+        return multipoles(np.broadcast_to(cent, a.center.shape), q)
 
     def __add__(a, b):
-        c = multipole()
-        c.q = [0 for _ in range(N)]
-
-        c.q[0] = a.q[0] + b.q[0]
-        c.center = (a.q[0] * a.center + b.q[0] * b.center) / c.q[0]
-
-        for k in range(1, len(c.q)):
-            c.q[k] = a.translate(k, c.center) + b.translate(k, c.center)
-
-        return c
-
+        assert a.order == b.order
+        qa, qb = a.q[..., :1], b.q[..., :1]
+        total = qa + qb
+        mid = (a.center + b.center) / 2
+        safe = np.where(total != 0, total, 1)
+        center = np.where(total != 0,
+                          (qa * a.center + qb * b.center) / safe, mid)
+        return multipoles(center, a.translate(center).q + b.translate(center).q)
+
+    def evaluate(self, points):
+        # sum_a,b (-1)^(a+b) / (a! b!) M_ab d^a/dx^a d^b/dy^b g(points - c)
+        d = derivatives(np.asarray(points) - self.center, self.order)
+        scale = np.array([(-1)**k / (math.factorial(k - j) * math.factorial(j))
+                          for k in range(self.order + 1)
+                          for j in range(k + 1)])
+        return (self.q * scale * d).sum(-1)
+
+
+def weighted_center(pos, charge):
+    total = charge.sum(-1)[..., None]
+    mean = pos.mean(-2)
+    safe = np.where(total != 0, total, 1)
+    return np.where(total != 0, (charge[..., None] * pos).sum(-2) / safe, mean)
 
 
 """
@@ -95,6 +99,19 @@ G = q g(r - r0)
 G = q g(r) - q r0 @ g'(r) - q r0 @@ g''(r) - q r0 @@@ g'''(r)
 """
 
-a = multipole(+1, 1, 0, 0, 0)
-b = multipole(-1, 1, 0, 0, 0)
-print(a + b)
+if __name__ == '__main__':
+    # thousands of random two-cluster pairs: P2M each, M2M by __add__,
+    # then compare against the direct sum at a far target
+    n, m = 4096, 8
+    rng = np.random.default_rng(0)
+    pos_a = rng.uniform(-0.1, 0.1, (n, m, 2)) + [-0.1, 0]
+    pos_b = rng.uniform(-0.1, 0.1, (n, m, 2)) + [+0.1, 0]
+    q_a = rng.uniform(0, 1, (n, m))
+    q_b = rng.uniform(0, 1, (n, m))
+    ab = multipoles.from_points(pos_a, q_a) + multipoles.from_points(pos_b, q_b)
+    target = rng.uniform(-1, 1, (n, 2)) + [3, 0]
+    pos = np.concatenate([pos_a, pos_b], 1)
+    q = np.concatenate([q_a, q_b], 1)
+    exact = (q * derivatives(target[:, None] - pos, 0)[..., 0]).sum(-1)
+    print(ab, 'max relative error:',
+          np.abs(ab.evaluate(target) / exact - 1).max())
@@ -3,6 +3,37 @@ import taichi as ti
 import taichi_glsl as tl
 import matplotlib.cm as cm
 from taichi_glsl import vec, vec2, D
+import argparse
+import math
+import subprocess
+import sys
+import time
+
+parser = argparse.ArgumentParser(description='2D point vortices')
+parser.add_argument('--particles', type=int, default=128,
+                    help='number of vortices')
+parser.add_argument('--method', choices=['direct', 'fmm', 'afmm', 'vic'],
+                    default='afmm', help='velocity evaluation method')
+parser.add_argument('--grid', type=int, default=32,
+                    help='fine cells per side of the two-grid fmm')
+parser.add_argument('--order', type=int, default=10,
+                    help='multipole expansion order p')
+parser.add_argument('--periodic', action='store_true',
+                    help='doubly periodic unit box (afmm and vic only)')
+parser.add_argument('--probe', action='store_true',
+                    help='draw the speed on a 512x512 probe grid')
+parser.add_argument('--bench', action='store_true',
+                    help='time one step of each method and exit')
+parser.add_argument('--accuracy', action='store_true',
+                    help='report error vs direct sum for each order and exit')
+parser.add_argument('--check', action='store_true',
+                    help='assert the afmm error is below 1e-4 for p >= 8 '
+                    'and exit')
+parser.add_argument('--bench-lists', type=int, nargs='*', metavar='M',
+                    help='time the full-grid scan against interaction lists '
+                    'at these grid sizes (default 32 64 128) and exit')
+args = parser.parse_args()
+
 ti.init()
 
 ti.Matrix.Yx = property(lambda u: vec(-u.y, u.x))
@@ -11,25 +42,115 @@ def rgb_to_hex(c):
     to255 = lambda x: np.minimum(255, np.maximum(0, np.int32(x * 255)))
     return 65536 * to255(c[0]) + 256 * to255(c[1]) + to255(c[2])
 
-N = 128
-M = 32
-M1 = 8
-PPC = 2 * (N // M)
+N = args.particles
+M = args.grid
+M1 = M // 4
 dt = 0.000002
 steps = 16
 cmap = cm.get_cmap('magma')
 p_vor = ti.var(ti.f32, N)
 p_pos = ti.Vector(2, ti.f32, N)
+# complex multipole coefficients a_0..a_p per cell, stored up to kMaxOrder
+# so the order can change at runtime without reallocating
+kMaxOrder = 16
+assert 1 <= args.order <= kMaxOrder
+kPeriodic = args.periodic
+assert not kPeriodic or args.method in ['afmm', 'vic']
+expansion_order = ti.var(ti.i32, ())
+binom = ti.var(ti.f32, (2 * kMaxOrder + 1, kMaxOrder + 1))
 g_com = ti.Vector(2, ti.f32, (M, M))
 g_vo0 = ti.var(ti.f32, (M, M))
-g_vo1 = ti.Vector(2, ti.f32, (M, M))
-g_pas = ti.var(ti.i32, (M, M, PPC))
+g_mul = ti.Vector(2, ti.f32, (M, M, kMaxOrder + 1))
+# particle ids counting-sorted by fine cell: cell g owns the contiguous
+# range g_pas[g_start[g]:g_start[g] + g_cnt[g]]
+g_pas = ti.var(ti.i32, N)
 g_cnt = ti.var(ti.i32, (M, M))
+g_start = ti.var(ti.i32, (M, M))
+g_fill = ti.var(ti.i32, (M, M))
+row_total = ti.var(ti.i32, M)
 h_com = ti.Vector(2, ti.f32, (M, M))
 h_vo0 = ti.var(ti.f32, (M1, M1))
-h_vo1 = ti.Vector(2, ti.f32, (M1, M1))
+h_mul = ti.Vector(2, ti.f32, (M1, M1, kMaxOrder + 1))
+h_cnt = ti.var(ti.i32, (M1, M1))
+# interaction lists, rebuilt each step from the non-empty cells: fine
+# neighbours (P2P), the rest of the parent's neighbours' children (fine
+# multipoles) and the coarse cells not adjacent to the parent
+kRatio = M // M1
+kFineFar = (3 * kRatio)**2 - 9
+g_near = ti.var(ti.i32, (M, M, 9))
+g_near_len = ti.var(ti.i32, (M, M))
+g_far = ti.var(ti.i32, (M, M, kFineFar))
+g_far_len = ti.var(ti.i32, (M, M))
+h_far = ti.var(ti.i32, (M1, M1, M1 * M1))
+h_far_len = ti.var(ti.i32, (M1, M1))
+p_vel = ti.Vector(2, ti.f32, N)
+p_psi = ti.var(ti.f32, N)
+ref_vel = ti.Vector(2, ti.f32, N)
 img = ti.Vector(3, ti.f32, (512, 512))
 eps = 1e-5
+# |d|^2 + softening in the pairwise kernel keeps close encounters stable;
+# the error reports set it to 0 so the direct sum is the exact one the
+# expansions approximate
+softening = ti.var(ti.f32, ())
+
+# vortex-in-cell: circulation is splatted onto a grid over the vortices'
+# bounding square, the free-space stream function psi = sum q log r comes
+# from a zero-padded FFT convolution (taichi has no FFT, numpy does it)
+kVicGrid = 256
+vic_omega = ti.var(ti.f32, (kVicGrid, kVicGrid))
+vic_vel = ti.Vector(2, ti.f32, (kVicGrid, kVicGrid))
+vic_origin = ti.Vector(2, ti.f32, ())
+vic_h = ti.var(ti.f32, ())
+
+# adaptive FMM: quadtree over the vortices' bounding square, built from
+# Morton-sorted particles, with the same complex expansions per node
+kTheta = 0.5  # targets take a node's multipole once r / distance < kTheta
+# node pairs interact by M2L once the gap between them is at least
+# kSeparation times the larger box; decided on integer cell coordinates so
+# a child is never judged closer to a source than its parent was. A gap of
+# 2 boxes puts the centres >= 3 boxes apart, past the sqrt(2) / kTheta the
+# radius criterion would ask for
+kSeparation = 2
+assert kSeparation + 1 > math.sqrt(2) / kTheta
+kLeafSize = 32
+kMortonBits = 15
+kMaxLevel = kMortonBits
+kMaxNodes = 16 * (N // kLeafSize + 1)
+kSortSize = 1 << (N - 1).bit_length()
+kLanes = min(kMaxNodes, 65536)
+kStackSize = 4 * (kMaxLevel + 1)
+kImages = 9 if kPeriodic else 1
+# periodic velocity per unit circulation is zeta(z) - pi conj(z) (Weierstrass
+# zeta of the unit square lattice, the conj term from the neutralizing
+# background); images beyond the 3x3 block enter through S_n = sum o^-n
+lattice_sum = ti.var(ti.f32, kMaxOrder + 2)
+s_key = ti.var(ti.i32, kSortSize)
+s_id = ti.var(ti.i32, kSortSize)
+t_begin = ti.var(ti.i32, kMaxNodes)
+t_end = ti.var(ti.i32, kMaxNodes)
+t_parent = ti.var(ti.i32, kMaxNodes)
+t_level = ti.var(ti.i32, kMaxNodes)
+t_leaf = ti.var(ti.i32, kMaxNodes)
+t_center = ti.Vector(2, ti.f32, kMaxNodes)
+t_size = ti.var(ti.f32, kMaxNodes)
+t_cell = ti.Vector(2, ti.i32, kMaxNodes)  # index among the level's 2^l x 2^l
+t_children = ti.var(ti.i32, (kMaxNodes, 2, 2))
+t_mul = ti.Vector(2, ti.f32, (kMaxNodes, kMaxOrder + 1))
+t_loc = ti.Vector(2, ti.f32, (kMaxNodes, kMaxOrder + 1))
+t_len = ti.var(ti.i32, ())
+level_begin = ti.var(ti.i32, kMaxLevel + 2)
+level_end = ti.var(ti.i32, kMaxLevel + 2)
+box_lo = ti.var(ti.f32, 2)
+box_hi = ti.var(ti.f32, 2)
+st_node = ti.var(ti.i32, (kLanes, kStackSize))
+# batched targets (probe grids, streamline seeds) walk the same tree
+kMaxTargets = 512 * 512
+kTargetLanes = 65536
+q_pos = ti.Vector(2, ti.f32, kMaxTargets)
+q_vel = ti.Vector(2, ti.f32, kMaxTargets)
+q_stack = ti.var(ti.i32, (kTargetLanes, kStackSize))
+# the far images' local expansion about the root, for periodic targets
+q_loc = ti.Vector(2, ti.f32, (1, kMaxOrder + 1))
 
 
 @ti.func
@@ -38,21 +159,68 @@ def cmul(a, b):
 
 @ti.func
 def crcp(a):
-    return tl.normalizePow(a, -1, eps).Yx
+    # zero for a == 0, so a vortex never moves itself
+    r = vec2(0.0)
+    d2 = a.norm_sqr() + softening[None]
+    if d2 > 0:
+        r = (a / d2).Yx
+    return r
 
 @ti.func
-def compute(d, m0, m1):
-    d = crcp(d)
-    r = d * m0
-    r += cmul(d, d) * m1
-    return r
+def cinv(a):
+    return vec(a.x, -a.y) / a.norm_sqr()
+
+@ti.func
+def compute(d, m0):
+    return crcp(d) * m0
+
+
+@ti.func
+def add_multipole(mul, c, z, q):
+    # P2M: a_0 += q, a_k -= q z^k / k
+    mul[c, 0] += vec(q, 0.0)
+    zk = z
+    for k in range(1, expansion_order[None] + 1):
+        mul[c, k] -= zk * (q / k)
+        zk = cmul(zk, z)
+
+
+@ti.func
+def shift_multipole(src, s, dst, d, z0):
+    # M2M: b_l += -a_0 z0^l / l + sum_{k<=l} a_k z0^(l-k) C(l-1, k-1)
+    order = expansion_order[None]
+    a0 = src[s, 0]
+    dst[d, 0] += a0
+    z0l = vec(1.0, 0.0)
+    for l in range(1, order + 1):
+        z0l = cmul(z0l, z0)
+        b = -cmul(a0, z0l) / l
+        z0lk = vec(1.0, 0.0)
+        k = l
+        while k >= 1:
+            b += cmul(src[s, k], z0lk) * binom[l - 1, k - 1]
+            z0lk = cmul(z0lk, z0)
+            k = k - 1
+        dst[d, l] += b
+
+
+@ti.func
+def multipole_velocity(mul, c, z):
+    # f = a_0 / z - sum k a_k / z^(k+1); velocity u + iv = i conj(f)
+    inv = cinv(z)
+    f = cmul(mul[c, 0], inv)
+    invk = inv
+    for k in range(1, expansion_order[None] + 1):
+        invk = cmul(invk, inv)
+        f -= cmul(mul[c, k], invk) * k
+    return vec(f.y, f.x)
 
 
 @ti.func
 def velocity(p):
     vel = vec2(0.0)
     for j in range(N):
-        vel += compute(p - p_pos[j], p_vor[j], vec2(0.0))
+        vel += compute(p - p_pos[j], p_vor[j])
     return vel
 
 
@@ -65,22 +233,50 @@ def is_close1(dp):
     return dp.norm_sqr() < (2 / M1) ** 2
 
 @ti.func
-def velocity_fmm(p):
+def cell_center(g, m):
+    return (g + 0.5) / m
+
+@ti.func
+def fine_cell(p):
+    return tl.clamp(int(p * M), 0, M - 1)
+
+@ti.func
+def unpack_cell(k, m):
+    return ti.Vector([k // m, k % m])
+
+@ti.func
+def velocity_fmm_scan(p):
     vel = vec2(0.0)
-    my_g = int(p * M)
-    #for g in ti.grouped(g_com):
     for g in ti.grouped(ti.ndrange(M, M)):
         dp = p - g_com[g]
         if is_close(dp):
-            for k in range(g_cnt[g]):
-                kk = g_pas[g, k]
-                vel += compute(p - p_pos[kk], p_vor[kk], vec2(0.0))
+            for k in range(g_start[g], g_start[g] + g_cnt[g]):
+                kk = g_pas[k]
+                vel += compute(p - p_pos[kk], p_vor[kk])
         elif is_close1(dp):
-            vel += compute(dp, g_vo0[g], g_vo1[g])
+            vel += multipole_velocity(g_mul, g, p - cell_center(g, M))
     for h in ti.grouped(ti.ndrange(M1, M1)):
         dp = p - h_com[h]
         if not is_close1(dp):
-            vel += compute(dp, h_vo0[h], h_vo1[h])
+            vel += multipole_velocity(h_mul, h, p - cell_center(h, M1))
+    return vel
+
+@ti.func
+def velocity_fmm(p):
+    vel = vec2(0.0)
+    g = fine_cell(p)
+    h = g // kRatio
+    for n in range(g_near_len[g]):
+        s = unpack_cell(g_near[g, n], M)
+        for k in range(g_start[s], g_start[s] + g_cnt[s]):
+            kk = g_pas[k]
+            vel += compute(p - p_pos[kk], p_vor[kk])
+    for n in range(g_far_len[g]):
+        s = unpack_cell(g_far[g, n], M)
+        vel += multipole_velocity(g_mul, s, p - cell_center(s, M))
+    for n in range(h_far_len[h]):
+        s = unpack_cell(h_far[h, n], M1)
+        vel += multipole_velocity(h_mul, s, p - cell_center(s, M1))
     return vel
 
 
@@ -92,72 +288,784 @@ def advance():
 
 
 @ti.kernel
-def advance_fmm():
-    p2m()
+def velocity_fmm_lists():
     m2m1()
+    build_lists()
     for i in p_pos:
-        vel = velocity_fmm(p_pos[i])
-        p_pos[i] = p_pos[i] + vel * dt
+        p_vel[i] = velocity_fmm(p_pos[i])
+
+
+@ti.kernel
+def velocity_fmm_scan_cells():
+    m2m1()
+    for i in p_pos:
+        p_vel[i] = velocity_fmm_scan(p_pos[i])
+
+
+def velocity_fmm_all():
+    p2m()
+    velocity_fmm_lists()
+
+
+def velocity_fmm_scan_all():
+    p2m()
+    velocity_fmm_scan_cells()
 
 
 @ti.kernel
 def init():
     for i in range(N):
-        p_pos[i] = tl.randNDRange(vec2(0.25), vec2(0.75))
+        if ti.static(kPeriodic):
+            p_pos[i] = tl.randND(2)
+        else:
+            p_pos[i] = tl.randNDRange(vec2(0.25), vec2(0.75))
         p_vor[i] = tl.randRange(0.0, 1.0)
 
 
+@ti.kernel
+def compute_bounds():
+    for d in ti.static(range(2)):
+        box_lo[d] = p_pos[0][d]
+        box_hi[d] = p_pos[0][d]
+    if ti.static(kPeriodic):
+        for d in ti.static(range(2)):
+            box_lo[d] = 0.0
+            box_hi[d] = 1.0
+    else:
+        for i in p_pos:
+            for d in ti.static(range(2)):
+                ti.atomic_min(box_lo[d], p_pos[i][d])
+                ti.atomic_max(box_hi[d], p_pos[i][d])
+
+
+@ti.func
+def spread_bits(x):
+    x = (x | (x << 8)) & 0x00ff00ff
+    x = (x | (x << 4)) & 0x0f0f0f0f
+    x = (x | (x << 2)) & 0x33333333
+    x = (x | (x << 1)) & 0x55555555
+    return x
+
+
+@ti.kernel
+def compute_keys(sort_len: ti.i32):
+    root_center = vec(box_lo[0] + box_hi[0], box_lo[1] + box_hi[1]) * 0.5
+    root_size = max(box_hi[0] - box_lo[0], box_hi[1] - box_lo[1]) * 1.001 + eps
+    if ti.static(kPeriodic):
+        root_size = 1.0  # the root must tile with its images
+    for i in range(sort_len):
+        if i < N:
+            u = (p_pos[i] - root_center) / root_size + 0.5
+            cell = tl.clamp(int(u * (1 << kMortonBits)), 0,
+                            (1 << kMortonBits) - 1)
+            s_key[i] = (spread_bits(cell.x) << 1) | spread_bits(cell.y)
+        else:
+            s_key[i] = 0x7fffffff
+        s_id[i] = i
+    t_center[0] = root_center
+    t_size[0] = root_size
+
+
+@ti.kernel
+def bitonic_step(sort_len: ti.i32, j: ti.i32, k: ti.i32):
+    for i in range(sort_len):
+        other = i ^ j
+        if other > i:
+            key_i = s_key[i]
+            key_other = s_key[other]
+            need_swap = key_i < key_other
+            if (i & k) == 0:
+                need_swap = key_i > key_other
+            if need_swap:
+                s_key[i] = key_other
+                s_key[other] = key_i
+                id_i = s_id[i]
+                s_id[i] = s_id[other]
+                s_id[other] = id_i
+
+
 @ti.func
-def build_tree():
-    pass
+def lower_bound_digit(begin, end, shift, digit):
+    lo = begin
+    hi = end
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if ((s_key[mid] >> shift) & 3) < digit:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+@ti.kernel
+def emit_root():
+    t_len[None] = 1
+    t_begin[0] = 0
+    t_end[0] = N
+    t_parent[0] = -1
+    t_level[0] = 0
+    t_cell[0] = ti.Vector([0, 0])
+    t_leaf[0] = N <= kLeafSize
+    level_begin[0] = 0
+    level_end[0] = 1
+
+
+@ti.kernel
+def emit_level(level: ti.i32):
+    shift = 2 * (kMortonBits - 1 - level)
+    for parent in range(level_begin[level], level_end[level]):
+        for c in ti.static(range(4)):
+            t_children[parent, c >> 1, c & 1] = -1
+        if t_leaf[parent]:
+            continue
+        begin = t_begin[parent]
+        end = t_end[parent]
+        child_size = t_size[parent] * 0.5
+        child_begin = begin
+        for c in ti.static(range(4)):
+            child_end = end
+            if ti.static(c < 3):
+                child_end = lower_bound_digit(child_begin, end, shift, c + 1)
+            if child_end > child_begin:
+                child = ti.atomic_add(t_len[None], 1)
+                t_begin[child] = child_begin
+                t_end[child] = child_end
+                t_parent[child] = parent
+                t_level[child] = level + 1
+                t_leaf[child] = (child_end - child_begin <= kLeafSize) | (
+                    level + 1 == kMaxLevel)
+                t_center[child] = t_center[parent] + (
+                    vec(c >> 1, c & 1) - 0.5) * child_size
+                t_size[child] = child_size
+                t_cell[child] = t_cell[parent] * 2 + ti.Vector([c >> 1, c & 1])
+                t_children[parent, c >> 1, c & 1] = child
+            child_begin = child_end
+
+
+def build_afmm_tree():
+    compute_bounds()
+    sort_len = 1 << max(0, N - 1).bit_length()
+    compute_keys(sort_len)
+    k = 2
+    while k <= sort_len:
+        j = k // 2
+        while j > 0:
+            bitonic_step(sort_len, j, k)
+            j //= 2
+        k *= 2
+    emit_root()
+    depth = 0
+    while depth < kMaxLevel:
+        width = level_end[depth] - level_begin[depth]
+        assert t_len[None] + 4 * width <= kMaxNodes, 'increase kMaxNodes'
+        emit_level(depth)
+        begin, end = level_end[depth], t_len[None]
+        if begin == end:
+            break
+        level_begin[depth + 1] = begin
+        level_end[depth + 1] = end
+        depth += 1
+    return depth
+
+
+@ti.kernel
+def upward_level(level: ti.i32):
+    # P2M at leaves, M2M elsewhere; a_0 = sum q, a_k = -sum q z^k / k
+    for node in range(level_begin[level], level_end[level]):
+        for k in range(expansion_order[None] + 1):
+            t_mul[node, k] = vec2(0.0)
+        center = t_center[node]
+        if t_leaf[node]:
+            for u in range(t_begin[node], t_end[node]):
+                j = s_id[u]
+                add_multipole(t_mul, node, p_pos[j] - center, p_vor[j])
+        else:
+            for c in ti.static(range(4)):
+                child = t_children[node, c >> 1, c & 1]
+                if child != -1:
+                    shift_multipole(t_mul, child, t_mul, node,
+                                    t_center[child] - center)
+
+
+@ti.func
+def cell_span(levels):
+    one = 1
+    return one << levels
+
+
+@ti.func
+def well_separated(cell_a, level_a, cell_b, level_b):
+    # exact: both boxes in cells of the finer level, then the Chebyshev gap
+    level = max(level_a, level_b)
+    size_a = cell_span(level - level_a)
+    size_b = cell_span(level - level_b)
+    lo_a = cell_a * size_a
+    lo_b = cell_b * size_b
+    gap_x = max(lo_b.x - lo_a.x - size_a, lo_a.x - lo_b.x - size_b)
+    gap_y = max(lo_b.y - lo_a.y - size_a, lo_a.y - lo_b.y - size_b)
+    return max(gap_x, gap_y) >= kSeparation * max(size_a, size_b)
+
+
+@ti.func
+def m2l(source, target, shift, potential: ti.template()):
+    order = expansion_order[None]
+    z0 = t_center[source] + shift - t_center[target]
+    inv = cinv(z0)
+    a0 = t_mul[source, 0]
+    if ti.static(potential):
+        # b_0 = a_0 log(-z0) + sum (-1)^k a_k / z0^k, only Re(b_0) is used
+        acc = vec2(0.0)
+        invk = vec(1.0, 0.0)
+        sign = 1.0
+        for k in range(1, order + 1):
+            invk = cmul(invk, inv)
+            sign = -sign
+            acc += cmul(t_mul[source, k], invk) * sign
+        t_loc[target, 0] += vec(a0.x * ti.log(z0.norm()) + acc.x, 0.0)
+    invl = vec(1.0, 0.0)
+    for l in range(1, order + 1):
+        invl = cmul(invl, inv)
+        acc = vec2(0.0)
+        invk = vec(1.0, 0.0)
+        sign = 1.0
+        for k in range(1, order + 1):
+            invk = cmul(invk, inv)
+            sign = -sign
+            acc += cmul(t_mul[source, k], invk) * (binom[l + k - 1, k - 1] *
+                                                   sign)
+        t_loc[target, l] += cmul(invl, acc - a0 / l)
+
+
+@ti.func
+def p2p(source, target, shift, potential: ti.template()):
+    for u in range(t_begin[target], t_end[target]):
+        i = s_id[u]
+        if ti.static(potential):
+            psi = 0.0
+            for w in range(t_begin[source], t_end[source]):
+                j = s_id[w]
+                if (j != i) | (shift.norm_sqr() > 0):
+                    d = p_pos[i] - p_pos[j] - shift
+                    psi += p_vor[j] * ti.log(d.norm())
+            p_psi[i] += psi
+        else:
+            vel = vec2(0.0)
+            for w in range(t_begin[source], t_end[source]):
+                j = s_id[w]
+                vel += compute(p_pos[i] - p_pos[j] - shift, p_vor[j])
+            p_vel[i] += vel
+
+
+@ti.func
+def interact(target, lane, potential: ti.template()):
+    # Every (target leaf, source leaf) pair is covered exactly once along
+    # the dual-tree path that descends both trees level by level: it is
+    # taken at the first pair of cells that is well separated, or by P2P
+    # once both are leaves. This walk finds the part of that path that
+    # belongs to `target`; ancestors come from its integer cell index, so
+    # every node pair gets the same answer whichever walk asks.
+    level = t_level[target]
+    cell = t_cell[target]
+    leaf = t_leaf[target]
+    parent_level = level
+    parent_cell = cell
+    if level > 0:
+        parent_level = level - 1
+        parent_cell = t_cell[t_parent[target]]
+
+    # periodic boxes also walk the 8 neighbouring copies of the source
+    # tree; farther images come in through add_lattice_terms
+    for image in range(kImages):
+        shift = vec2(0.0)
+        offset = ti.Vector([0, 0])
+        if ti.static(kPeriodic):
+            offset = ti.Vector([image // 3 - 1, image % 3 - 1])
+            shift = vec(image // 3 - 1, image % 3 - 1)
+        st_node[lane, 0] = 0
+        st_len = 1
+        while st_len > 0:
+            st_len = st_len - 1
+            source = st_node[lane, st_len]
+            source_level = t_level[source]
+            source_cell = t_cell[source] + offset * cell_span(source_level)
+            open_source = 0
+            if source_level < level:
+                ancestor = cell // cell_span(level - source_level)
+                if well_separated(ancestor, source_level, source_cell,
+                                  source_level) == 0:
+                    if t_leaf[source] == 0:
+                        open_source = 1
+                    elif well_separated(cell, level, source_cell,
+                                        source_level):
+                        if well_separated(parent_cell, parent_level,
+                                          source_cell, source_level) == 0:
+                            m2l(source, target, shift, potential)
+                    elif leaf:
+                        p2p(source, target, shift, potential)
+            elif well_separated(cell, level, source_cell, source_level):
+                m2l(source, target, shift, potential)
+            elif leaf:
+                if t_leaf[source]:
+                    p2p(source, target, shift, potential)
+                else:
+                    open_source = 1
+            if open_source:
+                for c in ti.static(range(4)):
+                    child = t_children[source, c >> 1, c & 1]
+                    if child != -1:
+                        assert st_len < kStackSize
+                        st_node[lane, st_len] = child
+                        st_len = st_len + 1
+
+
+@ti.kernel
+def interact_nodes(base: ti.i32, potential: ti.template()):
+    for lane in range(min(kLanes, t_len[None] - base)):
+        target = base + lane
+        for l in range(expansion_order[None] + 1):
+            t_loc[target, l] = vec2(0.0)
+        interact(target, lane, potential)
+
+
+@ti.kernel
+def downward_level(level: ti.i32, potential: ti.template()):
+    # L2L from the parent, then L2P at leaves; b_m += sum_l b_l C(l,m) t^(l-m)
+    order = expansion_order[None]
+    first = 1
+    if ti.static(potential):
+        first = 0
+    for node in range(level_begin[level], level_end[level]):
+        center = t_center[node]
+        if level > 0:
+            parent = t_parent[node]
+            t = center - t_center[parent]
+            for m in range(first, order + 1):
+                acc = vec2(0.0)
+                tlm = vec(1.0, 0.0)
+                for l in range(m, order + 1):
+                    acc += cmul(t_loc[parent, l], tlm) * binom[l, m]
+                    tlm = cmul(tlm, t)
+                t_loc[node, m] += acc
+        if t_leaf[node]:
+            for u in range(t_begin[node], t_end[node]):
+                i = s_id[u]
+                w = p_pos[i] - center
+                if ti.static(potential):
+                    # psi = Re(sum b_l w^l)
+                    phi = vec2(0.0)
+                    wl = vec(1.0, 0.0)
+                    for l in range(order + 1):
+                        phi += cmul(t_loc[node, l], wl)
+                        wl = cmul(wl, w)
+                    p_psi[i] += phi.x
+                else:
+                    f = vec2(0.0)
+                    wl = vec(1.0, 0.0)
+                    for l in range(1, order + 1):
+                        f += cmul(t_loc[node, l], wl) * l
+                        wl = cmul(wl, w)
+                    if ti.static(kPeriodic):
+                        f += background_field(p_pos[i])
+                    # velocity u + iv = i conj(f), with f = sum q / (z - z_j)
+                    p_vel[i] += vec(f.y, f.x)
+
+
+@ti.kernel
+def clear_velocity():
+    for i in p_vel:
+        p_vel[i] = vec2(0.0)
+        p_psi[i] = 0.0
+
+
+@ti.kernel
+def move_particles():
+    for i in p_pos:
+        p_pos[i] = p_pos[i] + p_vel[i] * dt
+        if ti.static(kPeriodic):
+            p_pos[i] = p_pos[i] - ti.floor(p_pos[i])
+
+
+def build_multipoles():
+    depth = build_afmm_tree()
+    for level in reversed(range(depth + 1)):
+        upward_level(level)
+    return depth
+
+
+@ti.func
+def add_lattice_local(loc, c):
+    # far images add -sum_n S_(n+1) sum_j q (z - z_j)^n, n = 3, 7, 11...
+    # (S_n vanishes unless 4 | n); as a local expansion about the root,
+    # using the moments mu_0 = a_0, mu_k = -k a_k
+    order = expansion_order[None]
+    for m in range(order):
+        acc = vec2(0.0)
+        for n in range(max(3, m), order + 1):
+            if n % 4 == 3:
+                k = n - m
+                mu = t_mul[0, 0]
+                if k > 0:
+                    mu = t_mul[0, k] * -k
+                sign = 1.0 - 2.0 * (k % 2)
+                acc -= mu * (lattice_sum[n + 1] * binom[n, m] * sign)
+        loc[c, m + 1] += acc / (m + 1)
+
+
+@ti.kernel
+def add_lattice_terms():
+    add_lattice_local(t_loc, 0)
+
+
+@ti.kernel
+def fill_target_lattice():
+    for l in range(kMaxOrder + 1):
+        q_loc[0, l] = vec2(0.0)
+    add_lattice_local(q_loc, 0)
+
+
+@ti.func
+def background_field(p):
+    # -pi sum q conj(z - z_j), from the root moments a_0 = sum q,
+    # a_1 = -sum q (z_j - c); a term of f, velocity u + iv = i conj(f)
+    x = p - t_center[0]
+    bg = cmul(t_mul[0, 0], x) + t_mul[0, 1]
+    return -vec(bg.x, -bg.y) * math.pi
+
+
+def fill_lattice_sums(radius=400):
+    # S_n over the square lattice outside the 3x3 block, by square shells
+    o = np.arange(-radius, radius + 1)
+    o = (o[:, None] + 1j * o[None, :]).ravel()
+    o = o[np.maximum(abs(o.real), abs(o.imag)) >= 2]
+    table = np.zeros(kMaxOrder + 2, np.float32)
+    for n in range(4, kMaxOrder + 2, 4):
+        table[n] = np.sum(o**-n).real
+    lattice_sum.from_numpy(table)
+
+
+def evaluate_afmm(potential):
+    assert not (kPeriodic and potential), 'periodic energy not implemented'
+    depth = build_multipoles()
+    clear_velocity()
+    for base in range(0, t_len[None], kLanes):
+        interact_nodes(base, potential)
+    if kPeriodic:
+        add_lattice_terms()
+    for level in range(depth + 1):
+        downward_level(level, potential)
+
+
+def velocity_afmm():
+    evaluate_afmm(False)
+
+
+@ti.kernel
+def evaluate_targets(base: ti.i32, count: ti.i32):
+    # M2P from every node well separated from the target, P2P at leaves;
+    # periodic boxes walk the 3x3 images and add the far images and the
+    # background like the L2P in downward_level does
+    for lane in range(min(kTargetLanes, count - base)):
+        p = q_pos[base + lane]
+        vel = vec2(0.0)
+        for image in range(kImages):
+            shift = vec2(0.0)
+            if ti.static(kPeriodic):
+                shift = vec(image // 3 - 1, image % 3 - 1)
+            q_stack[lane, 0] = 0
+            st_len = 1
+            while st_len > 0:
+                st_len = st_len - 1
+                node = q_stack[lane, st_len]
+                z = p - t_center[node] - shift
+                r = t_size[node] * (0.5 * math.sqrt(2))
+                if z.norm_sqr() * kTheta**2 > r * r:
+                    vel += multipole_velocity(t_mul, node, z)
+                elif t_leaf[node]:
+                    for u in range(t_begin[node], t_end[node]):
+                        j = s_id[u]
+                        vel += compute(p - p_pos[j] - shift, p_vor[j])
+                else:
+                    for c in ti.static(range(4)):
+                        child = t_children[node, c >> 1, c & 1]
+                        if child != -1:
+                            assert st_len < kStackSize
+                            q_stack[lane, st_len] = child
+                            st_len = st_len + 1
+        if ti.static(kPeriodic):
+            w = p - t_center[0]
+            f = background_field(p)
+            wl = vec(1.0, 0.0)
+            for l in range(1, expansion_order[None] + 1):
+                f += cmul(q_loc[0, l], wl) * l
+                wl = cmul(wl, w)
+            vel += vec(f.y, f.x)
+        q_vel[base + lane] = vel
+
+
+def velocity_at(points, rebuild=True):
+    # velocity induced by all vortices at a T x 2 batch of target points,
+    # O(N + T log N) instead of O(N T); pass rebuild=False to reuse the
+    # multipoles of the previous call while the vortices haven't moved
+    points = np.asarray(points, np.float32).reshape(-1, 2)
+    if kPeriodic:
+        points = points - np.floor(points)
+    if rebuild:
+        build_multipoles()
+        if kPeriodic:
+            fill_target_lattice()
+    out = np.empty_like(points)
+    for start in range(0, len(points), kMaxTargets):
+        chunk = points[start:start + kMaxTargets]
+        padded = np.zeros((kMaxTargets, 2), np.float32)
+        padded[:len(chunk)] = chunk
+        q_pos.from_numpy(padded)
+        for base in range(0, len(chunk), kTargetLanes):
+            evaluate_targets(base, len(chunk))
+        out[start:start + len(chunk)] = q_vel.to_numpy()[:len(chunk)]
+    return out
+
+
+def paint_speed():
+    res = 512
+    x = (np.arange(res) + 0.5) / res
+    grid = np.stack(np.meshgrid(x, x, indexing='ij'), axis=-1)
+    speed = np.linalg.norm(velocity_at(grid), axis=1).reshape(res, res)
+    img.from_numpy(cmap(speed / speed.max())[..., :3].astype(np.float32))
+
+
+def energy_afmm():
+    # the stream function at every vortex through the same tree as the
+    # velocity, then a per-vortex sum on the host instead of one atomic
+    # accumulator; same value as energy(), in O(N)
+    evaluate_afmm(True)
+    return float(np.dot(p_vor.to_numpy().astype(np.float64),
+                        p_psi.to_numpy()))
+
+
+def advance_afmm():
+    velocity_afmm()
+    move_particles()
+
+
+def advance_fmm():
+    velocity_fmm_all()
+    move_particles()
+
+
+def vic_green():
+    # log r on the doubled grid in cell units, offsets wrapped for the
+    # circular convolution; log h only shifts psi by a constant
+    n = kVicGrid
+    d = np.fft.fftfreq(2 * n, 1 / (2 * n))
+    r = np.hypot(d[:, None], d[None, :])
+    r[0, 0] = 0.5
+    return np.fft.rfft2(np.log(r))
+
+
+@ti.kernel
+def vic_splat():
+    size = max(box_hi[0] - box_lo[0], box_hi[1] - box_lo[1]) * 1.001 + eps
+    vic_origin[None] = vec(box_lo[0], box_lo[1])
+    vic_h[None] = size / (kVicGrid - 2)
+    if ti.static(kPeriodic):
+        vic_h[None] = 1.0 / kVicGrid
+    for I in ti.grouped(vic_omega):
+        vic_omega[I] = 0.0
+    for i in p_pos:
+        u = (p_pos[i] - vic_origin[None]) / vic_h[None]
+        base = int(u)
+        wx = vec(base.x + 1 - u.x, u.x - base.x)
+        wy = vec(base.y + 1 - u.y, u.y - base.y)
+        for a in ti.static(range(2)):
+            for b in ti.static(range(2)):
+                node = (base + ti.Vector([a, b])) % kVicGrid
+                vic_omega[node] += p_vor[i] * wx[a] * wy[b]
+
+
+@ti.kernel
+def vic_gather():
+    for i in p_pos:
+        u = (p_pos[i] - vic_origin[None]) / vic_h[None]
+        base = int(u)
+        wx = vec(base.x + 1 - u.x, u.x - base.x)
+        wy = vec(base.y + 1 - u.y, u.y - base.y)
+        vel = vec2(0.0)
+        for a in ti.static(range(2)):
+            for b in ti.static(range(2)):
+                node = (base + ti.Vector([a, b])) % kVicGrid
+                vel += vic_vel[node] * wx[a] * wy[b]
+        p_vel[i] = vel
+
+
+def velocity_vic():
+    compute_bounds()
+    vic_splat()
+    n = kVicGrid
+    h = vic_h[None]
+    if kPeriodic:
+        # laplacian(psi) = 2 pi (omega - mean), solved spectrally; dropping
+        # k = 0 is the neutralizing background
+        omega_hat = np.fft.rfft2(vic_omega.to_numpy()) / h**2
+        kx = 2 * np.pi * np.fft.fftfreq(n, h)[:, None]
+        ky = 2 * np.pi * np.fft.rfftfreq(n, h)[None, :]
+        k2 = kx**2 + ky**2
+        k2[0, 0] = 1
+        psi_hat = -2 * np.pi * omega_hat / k2
+        psi_hat[0, 0] = 0
+        vel = np.stack([
+            np.fft.irfft2(-1j * ky * psi_hat, (n, n)),
+            np.fft.irfft2(1j * kx * psi_hat, (n, n))
+        ], axis=-1)
+    else:
+        shape = (2 * n, 2 * n)
+        omega_hat = np.fft.rfft2(vic_omega.to_numpy(), shape)
+        psi = np.fft.irfft2(omega_hat * vic_green_hat, shape)[:n, :n]
+        # u = -d(psi)/dy, v = d(psi)/dx; fields are indexed [x, y]
+        psi_x, psi_y = np.gradient(psi)
+        vel = np.stack([-psi_y, psi_x], axis=-1) / h
+    vic_vel.from_numpy(vel.astype(np.float32))
+    vic_gather()
+
+
+def advance_vic():
+    velocity_vic()
+    move_particles()
 
 
 @ti.func
 def m2m1():
-    for h in ti.grouped(h_com):
+    for h in ti.grouped(h_cnt):
         h_vo0[h] = 0.0
-        h_vo1[h] = vec2(0.0)
         h_com[h] = vec2(0.0)
+        h_cnt[h] = 0
+    for I in ti.grouped(h_mul):
+        h_mul[I] = vec2(0.0)
     for g in ti.grouped(g_com):
-        h = int(g_com[g] * M1)
-        h_com[h] += g_com[g]
+        h = g // kRatio
+        h_com[h] += g_com[g] * g_cnt[g]
         h_vo0[h] += g_vo0[g]
-    for h in ti.grouped(h_com):
-        if h_vo0[h] != 0.0:
-            h_com[h] = h_com[h] / h_vo0[h]
+        h_cnt[h] += g_cnt[g]
+    # h_com is the particle mean, like g_com; empty cells use their center
+    for h in ti.grouped(h_cnt):
+        if h_cnt[h] != 0:
+            h_com[h] = h_com[h] / h_cnt[h]
         else:
-            h_com[h] = h_com[h] / (M // M1)
+            h_com[h] = cell_center(h, M1)
     for g in ti.grouped(g_com):
-        h = int(g_com[g] * M1)
-        h_vo1[h] += g_vo0[g] * (h_com[h] - g_com[g])
-        h_vo1[h] += g_vo1[g]
+        h = g // kRatio
+        shift_multipole(g_mul, g, h_mul, h,
+                        cell_center(g, M) - cell_center(h, M1))
 
 
 @ti.func
-def p2m():
+def inside(g, m):
+    return (g.x >= 0) & (g.x < m) & (g.y >= 0) & (g.y < m)
+
+@ti.func
+def build_lists():
+    for g in ti.grouped(g_cnt):
+        h = g // kRatio
+        near_len = 0
+        far_len = 0
+        for dx in ti.static(range(-1, 2)):
+            for dy in ti.static(range(-1, 2)):
+                hs = h + ti.Vector([dx, dy])
+                if inside(hs, M1):
+                    for a in range(kRatio):
+                        for b in range(kRatio):
+                            s = hs * kRatio + ti.Vector([a, b])
+                            if g_cnt[s] != 0:
+                                if max(abs(s.x - g.x), abs(s.y - g.y)) <= 1:
+                                    g_near[g, near_len] = s.x * M + s.y
+                                    near_len += 1
+                                else:
+                                    g_far[g, far_len] = s.x * M + s.y
+                                    far_len += 1
+        g_near_len[g] = near_len
+        g_far_len[g] = far_len
+    for h in ti.grouped(h_cnt):
+        far_len = 0
+        for x in range(M1):
+            for y in range(M1):
+                if (max(abs(x - h.x), abs(y - h.y)) > 1) & (h_cnt[x, y] != 0):
+                    h_far[h, far_len] = x * M1 + y
+                    far_len += 1
+        h_far_len[h] = far_len
+
+
+@ti.kernel
+def count_particles():
     for g in ti.grouped(g_com):
         g_vo0[g] = 0.0
-        g_vo1[g] = vec2(0.0)
         g_com[g] = vec2(0.0)
         g_cnt[g] = 0
+        g_fill[g] = 0
+    for i in p_pos:
+        g_cnt[fine_cell(p_pos[i])] += 1
+
+
+@ti.kernel
+def prefix_cells():
+    # exclusive prefix sum of g_cnt: rows in parallel, then row offsets
+    for x in range(M):
+        acc = 0
+        for y in range(M):
+            g_start[x, y] = acc
+            acc += g_cnt[x, y]
+        row_total[x] = acc
+    # serial, a top-level while runs on one thread: each row's offset
+    # depends on every row before it, and M adds beat a parallel scan
+    acc = 0
+    x = 0
+    while x < M:
+        total = row_total[x]
+        row_total[x] = acc
+        acc += total
+        x = x + 1
+    for g in ti.grouped(g_start):
+        g_start[g] += row_total[g.x]
+
+
+@ti.kernel
+def scatter_particles():
     for i in p_pos:
-        g = int(p_pos[i] * M)
-        g_com[g] += p_pos[i]
-        g_vo0[g] += p_vor[i]
-        k = ti.atomic_add(g_cnt[g], 1)
-        g_pas[g, k] = i
+        g = fine_cell(p_pos[i])
+        g_pas[g_start[g] + ti.atomic_add(g_fill[g], 1)] = i
+
+
+@ti.kernel
+def cell_moments():
+    for I in ti.grouped(g_mul):
+        g_mul[I] = vec2(0.0)
+    # each cell walks its own range, so no atomics on the moments
     for g in ti.grouped(g_com):
+        center = cell_center(g, M)
+        for k in range(g_start[g], g_start[g] + g_cnt[g]):
+            i = g_pas[k]
+            g_com[g] += p_pos[i]
+            g_vo0[g] += p_vor[i]
+            add_multipole(g_mul, g, p_pos[i] - center, p_vor[i])
         if g_cnt[g] != 0:
             g_com[g] = g_com[g] / g_cnt[g]
         else:
-            g_com[g] = (g + 0.5) / M
-    for i in p_pos:
-        g = int(p_pos[i] * M)
-        g_vo1[g] += p_vor[i] * (g_com[g] - p_pos[i])
+            g_com[g] = center
+
+
+def p2m():
+    # counting sort by fine cell: count, prefix sum, scatter
+    count_particles()
+    prefix_cells()
+    scatter_particles()
+    cell_moments()
+
+
+def render(mx, my):
+    p2m()
+    render_arrows(mx, my)
 
 
 @ti.kernel
-def render(mx: ti.f32, my: ti.f32):
+def render_arrows(mx: ti.f32, my: ti.f32):
     mouse = vec(mx, my)
 
     dir = velocity(mouse) * 0.002
@@ -165,7 +1073,8 @@ def render(mx: ti.f32, my: ti.f32):
         dir = dir.normalized()
     tl.paintArrow(img, mouse, dir, D.xyy)
 
-    p2m()
+    m2m1()
+    build_lists()
     dir = velocity_fmm(mouse) * 0.002
     if dir.norm() > 1:
         dir = dir.normalized()
@@ -183,16 +1092,181 @@ def energy():
 
 
 
+def fill_binomials():
+    table = np.zeros((2 * kMaxOrder + 1, kMaxOrder + 1), np.float32)
+    for n in range(2 * kMaxOrder + 1):
+        for k in range(min(n, kMaxOrder) + 1):
+            table[n, k] = math.comb(n, k)
+    binom.from_numpy(table)
+
+
+@ti.kernel
+def direct_velocity(count: ti.i32):
+    for i in range(count):
+        ref_vel[i] = velocity(p_pos[i])
+
+
+@ti.kernel
+def velocity_error(count: ti.i32) -> ti.f32:
+    err = 0.0
+    ref = 0.0
+    for i in range(count):
+        err += (p_vel[i] - ref_vel[i]).norm_sqr()
+        ref += ref_vel[i].norm_sqr()
+    return ti.sqrt(err / ref)
+
+
+def accuracy_report():
+    # relative L2 velocity error against the exact direct sum, sampled on
+    # the first vortices (they are placed randomly), and cost per
+    # evaluation; p runs all the way to kMaxOrder
+    softening[None] = 0.0
+    count = min(N, 4096)
+    direct_velocity(count)
+    for name, evaluate in [('fmm', velocity_fmm_all),
+                           ('afmm', velocity_afmm)]:
+        for order in range(1, kMaxOrder + 1):
+            expansion_order[None] = order
+            evaluate()  # warm up, includes JIT compilation
+            ti.sync()
+            t0 = time.perf_counter()
+            for i in range(steps):
+                evaluate()
+            ti.sync()
+            ms = (time.perf_counter() - t0) / steps * 1e3
+            print(f'{name:6s} p = {order:2d}: error {velocity_error(count):.3e}, '
+                  f'{ms:.2f} ms')
+    expansion_order[None] = args.order
+    softening[None] = eps
+    if N <= 16384:
+        print('energy (direct):')
+        energy()
+        print(f'energy (afmm): {energy_afmm()}')
+
+
+def accuracy_check(tolerance=1e-4):
+    softening[None] = 0.0
+    count = min(N, 4096)
+    direct_velocity(count)
+    for order in range(8, kMaxOrder + 1):
+        expansion_order[None] = order
+        velocity_afmm()
+        error = velocity_error(count)
+        print(f'afmm   p = {order:2d}: error {error:.3e}')
+        assert error < tolerance, f'afmm p = {order}: error {error:.3e}'
+
+
+def benchmark_periodic():
+    # no periodic direct sum to compare to; the two periodic solvers
+    # should agree up to the VIC grid resolution
+    velocity_vic()
+    vic = p_vel.to_numpy()
+    velocity_afmm()
+    afmm = p_vel.to_numpy()
+    print(f'afmm vs vic: relative difference '
+          f'{np.linalg.norm(afmm - vic) / np.linalg.norm(afmm):.3e}')
+    for name, step in [('afmm', advance_afmm), ('vic', advance_vic)]:
+        step()  # warm up, includes JIT compilation
+        ti.sync()
+        t0 = time.perf_counter()
+        for i in range(steps):
+            step()
+        ti.sync()
+        print(f'{name:6s}: {(time.perf_counter() - t0) / steps * 1e3:.2f} '
+              f'ms/step, N = {N}, periodic')
+
+
+def benchmark():
+    if kPeriodic:
+        benchmark_periodic()
+        return
+    softening[None] = 0.0
+    count = min(N, 4096)
+    direct_velocity(count)
+    for name, evaluate in [('fmm', velocity_fmm_all),
+                           ('afmm', velocity_afmm), ('vic', velocity_vic)]:
+        evaluate()
+        print(f'{name:6s}: error {velocity_error(count):.3e}')
+    softening[None] = eps
+    methods = [('fmm', advance_fmm), ('afmm', advance_afmm),
+               ('vic', advance_vic)]
+    if N <= 16384:
+        methods.insert(0, ('direct', advance))
+    for name, step in methods:
+        step()  # warm up, includes JIT compilation
+        ti.sync()
+        t0 = time.perf_counter()
+        for i in range(steps):
+            step()
+        ti.sync()
+        print(f'{name:6s}: {(time.perf_counter() - t0) / steps * 1e3:.2f} '
+              f'ms/step, N = {N}')
+
+
+def benchmark_lists(sizes):
+    if sizes != [M]:
+        # grid sizes are compile-time field shapes, so run one process each
+        for m in sizes:
+            subprocess.run([
+                sys.executable, sys.argv[0], '--particles', str(N), '--order',
+                str(args.order), '--grid', str(m), '--bench-lists', str(m)
+            ], check=True)
+        return
+    softening[None] = 0.0
+    count = min(N, 4096)
+    direct_velocity(count)
+    results = []
+    for name, evaluate in [('scan', velocity_fmm_scan_all),
+                           ('lists', velocity_fmm_all)]:
+        evaluate()  # warm up, includes JIT compilation
+        ti.sync()
+        t0 = time.perf_counter()
+        for i in range(steps):
+            evaluate()
+        ti.sync()
+        results.append((time.perf_counter() - t0) / steps * 1e3)
+        print(f'M = {M:3d} {name:5s}: {results[-1]:.2f} ms, '
+              f'error {velocity_error(count):.3e}')
+    print(f'M = {M:3d} speedup: {results[0] / results[1]:.1f}x')
+
+
+methods = dict(direct=advance,
+               fmm=advance_fmm,
+               afmm=advance_afmm,
+               vic=advance_vic)
+
+softening[None] = eps
+fill_binomials()
+vic_green_hat = vic_green()
+fill_lattice_sums()
+expansion_order[None] = args.order
 init()
+if args.bench:
+    benchmark()
+    raise SystemExit
+if args.accuracy:
+    accuracy_report()
+    raise SystemExit
+if args.check:
+    assert not kPeriodic, 'no periodic direct sum to check against'
+    accuracy_check()
+    raise SystemExit
+if args.bench_lists is not None:
+    benchmark_lists(args.bench_lists or [32, 64, 128])
+    raise SystemExit
 with ti.GUI('Vortices', background_color=rgb_to_hex(cmap(0))) as gui:
     gui.frame = 0
     while gui.running and not gui.get_event(gui.ESCAPE):
         for i in range(steps):
-            advance_fmm()
-        if gui.frame % 100 == 0:
-            energy()
+            methods[args.method]()
+        if gui.frame % 100 == 0 and not kPeriodic:
+            print(energy_afmm())
         img.fill(0.0)
-        render(*gui.get_cursor_pos())
+        if args.probe:
+            paint_speed()
+        if not kPeriodic:
+            # the arrows come from the free-space direct and two-grid sums
+            render(*gui.get_cursor_pos())
         colors = rgb_to_hex(cmap(np.abs(p_vor.to_numpy())).transpose())
         gui.set_image(img)
         gui.circles(p_pos.to_numpy(), radius=2, color=colors)
@@ -1,5 +1,6 @@
 import taichi as ti
 import taichi_glsl as tl
+import stencil
 import matplotlib.cm as cm
 cmap = cm.get_cmap('magma')
 
@@ -15,18 +16,7 @@ ti.root.dense(ti.ij, N).place(y)
 ti.root.dense(ti.ij, N).place(b)
 
 
-links = [[-1, 0], [1, 0], [0, -1], [0, 1]]
-weights = [1, 1, 1, 1]
-links = [ti.Vector(_) for _ in links]
-@ti.kernel
-def possion(x: ti.template(), y: ti.template(), m: ti.template()):
-    for i in ti.grouped(x):
-        if b[i] != 0:
-            continue
-        avg = x[i] * 0
-        for dir, wei in ti.static(zip(links, weights)):
-            avg += wei * tl.sample(x, i + dir * m)
-        y[i] = avg / sum(weights)
+relax = stencil.Jacobi(N, 30, mask=b)
 
 
 @ti.kernel
@@ -63,8 +53,6 @@ with ti.GUI('Possion Solver') as gui:
             press_b(*gui.get_cursor_pos())
         if gui.is_pressed(gui.RMB):
             press_x(*gui.get_cursor_pos())
-        for i in range(15):
-            possion(x, y, 1)
-            possion(y, x, 1)
+        relax(x, y)
         gui.set_image(cmap(x.to_numpy()))
         gui.show()
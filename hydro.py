@@ -1,6 +1,8 @@
+import time
 import numpy as np
 import taichi as ti
 import taichi_glsl as tl
+import stencil
 import matplotlib.cm as cm
 
 cmap = cm.get_cmap('magma')
@@ -19,65 +21,311 @@ N = 600
 NN = N, N
 dx = 1 / N
 dt = 0.01
+kPressureSolver = 'mgpcg'  # or 'multigrid', 'jacobi'
+kReportEvery = 60  # frames between solver reports, 0 to disable
+kJacobiIterations = 10
+kMGCycles = 4  # at most, warm-started from last frame's pressure
+kMGTolerance = 1e-3  # stop once |residual| <= kMGTolerance * |rhs|
+kMGCycleType = 'V'  # 'W' visits each coarse level twice per cycle
+kMGSmooth = 2  # red-black Gauss-Seidel sweeps before and after
+kMGCoarsest = 16
+kMGCoarseSweeps = 32
+kPCGTolerance = 1e-5  # relative to |rhs|
+kPCGMaxIterations = 50
 
 dye = Pair(ti.var(ti.f32, NN), ti.var(ti.f32, NN))
 pre = Pair(ti.var(ti.f32, NN), ti.var(ti.f32, NN))
 vel = Pair(ti.Vector(2, ti.f32, NN), ti.Vector(2, ti.f32, NN))
 div = ti.var(ti.f32, NN)
+# everything advected by the flow, including the flow itself; append a
+# Pair (e.g. temperature) here and advect_carried picks it up
+carried = [vel, dye]
+grid = stencil.Grid(N)
+pressure_jacobi = stencil.Jacobi(N, kJacobiIterations, rhs=div)
+
+# pressure solves L p = 4 div - mean, L p = sum over in-grid neighbours
+# of (p_n - p), the same system the Jacobi iteration relaxes
+mg_n = [N]
+while mg_n[-1] > kMGCoarsest:
+    mg_n.append((mg_n[-1] + 1) // 2)
+mg_x = [None] + [ti.var(ti.f32, (n, n)) for n in mg_n[1:]]
+mg_b = [ti.var(ti.f32, (n, n)) for n in mg_n]
+mg_r = [ti.var(ti.f32, (n, n)) for n in mg_n]
+cg_r = ti.var(ti.f32, NN)
+cg_z = ti.var(ti.f32, NN)
+cg_p = ti.var(ti.f32, NN)
+cg_q = ti.var(ti.f32, NN)
+div_sum = ti.var(ti.f32, ())
+dot_sum = ti.var(ti.f32, ())
 
 
 @ti.kernel
-def advect(new: ti.template(), old: ti.template(), vel: ti.template()):
+def advect_carried(vel: ti.template()):
+    # one backtrace for every carried quantity; the Pairs are resolved at
+    # compile time, which is sound because they all swap together, so
+    # vel (vel.old) alone tells the two instances apart
     for P in ti.grouped(ti.ndrange(*NN)):
-        vel_P = vel[P]
-        btP = P - vel_P * (N * dt)
-        new[P] = tl.bilerp(old, btP)
+        btP = P - vel[P] * (N * dt)
+        for q in ti.static(carried):
+            q.new[P] = tl.bilerp(q.old, btP)
+
+
+@ti.func
+def divergence_at(g: ti.template(), P, edge: ti.template(),
+                  vel: ti.template(), div: ti.template()):
+    l = vel[stencil.at(g, P + tl.D.zy, edge)].x
+    r = vel[stencil.at(g, P + tl.D.xy, edge)].x
+    b = vel[stencil.at(g, P + tl.D.yz, edge)].y
+    t = vel[stencil.at(g, P + tl.D.yx, edge)].y
+    div[P] = (r - l + t - b) * (0.125 * dx)
+
+
+def divergence(vel):
+    stencil.apply(grid, divergence_at, vel, div)
+
+
+@ti.func
+def sub_grad_at(g: ti.template(), P, edge: ti.template(),
+                vel: ti.template(), pre: ti.template()):
+    l = pre[stencil.at(g, P + tl.D.zy, edge)]
+    r = pre[stencil.at(g, P + tl.D.xy, edge)]
+    b = pre[stencil.at(g, P + tl.D.yz, edge)]
+    t = pre[stencil.at(g, P + tl.D.yx, edge)]
+    vel[P] = vel[P] - (0.5 / dx) * tl.vec(r - l, t - b)
+
+
+def sub_grad(vel, pre):
+    stencil.apply(grid, sub_grad_at, vel, pre)
+
+
+@ti.func
+def laplacian_terms(x, I, n):
+    # (sum of the in-grid neighbours, how many there are)
+    terms = tl.vec(0.0, 0.0)
+    for d in ti.static([(-1, 0), (1, 0), (0, -1), (0, 1)]):
+        J = I + tl.vec(*d)
+        if (J.x >= 0) & (J.x < n) & (J.y >= 0) & (J.y < n):
+            terms += tl.vec(x[J], 1.0)
+    return terms
 
 
 @ti.kernel
-def divergence(vel: ti.template()):
-    for P in ti.grouped(ti.ndrange(*NN)):
-        l = tl.sample(vel, P + tl.D.zy).x
-        r = tl.sample(vel, P + tl.D.xy).x
-        b = tl.sample(vel, P + tl.D.yz).y
-        t = tl.sample(vel, P + tl.D.yx).y
-        div[P] = (r - l + t - b) * (0.125 * dx)
+def pressure_rhs(b: ti.template()):
+    div_sum[None] = 0.0
+    for P in ti.grouped(div):
+        div_sum[None] += div[P]
+    for P in ti.grouped(div):
+        b[P] = 4 * (div[P] - div_sum[None] / (N * N))
 
 
 @ti.kernel
-def jacobi(new: ti.template(), old: ti.template()):
-    for P in ti.grouped(ti.ndrange(*NN)):
-        l = tl.sample(old, P + tl.D.zy)
-        r = tl.sample(old, P + tl.D.xy)
-        b = tl.sample(old, P + tl.D.yz)
-        t = tl.sample(old, P + tl.D.yx)
-        new[P] = (r + l + t + b) * 0.25 - div[P]
+def smooth(x: ti.template(), b: ti.template(), n: ti.template(),
+           color: ti.template()):
+    for I in ti.grouped(x):
+        if (I.x + I.y) % 2 == color:
+            terms = laplacian_terms(x, I, n)
+            x[I] = (terms.x - b[I]) / terms.y
 
 
 @ti.kernel
-def sub_grad(vel: ti.template(), pre: ti.template()):
-    for P in ti.grouped(ti.ndrange(*NN)):
-        l = tl.sample(pre, P + tl.D.zy)
-        r = tl.sample(pre, P + tl.D.xy)
-        b = tl.sample(pre, P + tl.D.yz)
-        t = tl.sample(pre, P + tl.D.yx)
-        vel[P] = vel[P] - (0.5 / dx) * tl.vec(r - l, t - b)
+def residual(x: ti.template(), b: ti.template(), r: ti.template(),
+             n: ti.template()):
+    for I in ti.grouped(x):
+        terms = laplacian_terms(x, I, n)
+        r[I] = b[I] - (terms.x - terms.y * x[I])
 
 
-def substep():
-    advect(vel.new, vel.old, vel.old)
-    advect(dye.new, dye.old, vel.old)
-    dye.swap()
-    vel.swap()
+@ti.kernel
+def apply_laplacian(x: ti.template(), q: ti.template()):
+    for I in ti.grouped(x):
+        terms = laplacian_terms(x, I, N)
+        q[I] = terms.x - terms.y * x[I]
+
+
+@ti.kernel
+def dot_kernel(a: ti.template(), b: ti.template()):
+    dot_sum[None] = 0.0
+    for I in ti.grouped(a):
+        dot_sum[None] += a[I] * b[I]
+
+
+def dot(a, b):
+    dot_kernel(a, b)
+    return dot_sum[None]
+
+
+def norm(x):
+    return dot(x, x) ** 0.5
+
+
+@ti.kernel
+def axpy(y: ti.template(), a: ti.f32, x: ti.template()):
+    for I in ti.grouped(y):
+        y[I] = y[I] + a * x[I]
+
+
+@ti.kernel
+def xpay(y: ti.template(), x: ti.template(), a: ti.f32):
+    for I in ti.grouped(y):
+        y[I] = x[I] + a * y[I]
+
+
+@ti.func
+def prolong_weight(i, j, nc):
+    # 1D bilinear weight of coarse cell j in fine cell i, clamped at the
+    # ends the way tl.bilerp clamps
+    pos = (i + 0.5) * 0.5 - 0.5
+    lo = int(ti.floor(pos))
+    f = pos - lo
+    w = 0.0
+    if max(lo, 0) == j:
+        w += 1 - f
+    if min(lo + 1, nc - 1) == j:
+        w += f
+    return w
+
+
+@ti.kernel
+def restrict(r: ti.template(), bc: ti.template(), n: ti.template(),
+             nc: ti.template()):
+    # full weighting, the exact transpose of prolongate; its weights sum
+    # to 4, which is what the coarse cells need: spacing doubles, L ~ h^2 lap
+    for J in ti.grouped(bc):
+        total = 0.0
+        for a in ti.static(range(-1, 3)):
+            for b in ti.static(range(-1, 3)):
+                I = J * 2 + tl.vec(a, b)
+                if (I.x >= 0) & (I.x < n) & (I.y >= 0) & (I.y < n):
+                    w = (prolong_weight(I.x, J.x, nc) *
+                         prolong_weight(I.y, J.y, nc))
+                    total += w * r[I]
+        bc[J] = total
+
+
+@ti.kernel
+def prolongate(xc: ti.template(), x: ti.template(), nc: ti.template()):
+    for I in ti.grouped(x):
+        lo = int(ti.floor((I + 0.5) * 0.5 - 0.5))
+        total = 0.0
+        for a in ti.static(range(2)):
+            for b in ti.static(range(2)):
+                # the weights already fold clamped neighbours into the
+                # edge cell, so out-of-grid candidates are skipped
+                J = lo + tl.vec(a, b)
+                if (J.x >= 0) & (J.x < nc) & (J.y >= 0) & (J.y < nc):
+                    total += (prolong_weight(I.x, J.x, nc) *
+                              prolong_weight(I.y, J.y, nc) * xc[J])
+        x[I] = x[I] + total
+
+
+def smooth_sweeps(x, b, n, sweeps, colors=(0, 1)):
+    for _ in range(sweeps):
+        for color in colors:
+            smooth(x, b, n, color)
+
+
+def mg_cycle(level, x, b):
+    # post-smoothing runs the colours in reverse and restrict is the
+    # transpose of prolongate, so the cycle is a symmetric operator and
+    # usable as a CG preconditioner
+    n = mg_n[level]
+    if level == len(mg_n) - 1:
+        smooth_sweeps(x, b, n, kMGCoarseSweeps // 2)
+        smooth_sweeps(x, b, n, kMGCoarseSweeps // 2, (1, 0))
+        return
+    smooth_sweeps(x, b, n, kMGSmooth)
+    for _ in range(2 if kMGCycleType == 'W' else 1):
+        residual(x, b, mg_r[level], n)
+        restrict(mg_r[level], mg_b[level + 1], n, mg_n[level + 1])
+        mg_x[level + 1].fill(0)
+        mg_cycle(level + 1, mg_x[level + 1], mg_b[level + 1])
+        prolongate(mg_x[level + 1], x, mg_n[level + 1])
+    smooth_sweeps(x, b, n, kMGSmooth, (1, 0))
 
-    divergence(vel.old)
-    for _ in range(10):
-        jacobi(pre.new, pre.old)
-        pre.swap()
 
+def solve_multigrid(x, b):
+    # returns (cycles, |residual| / |rhs|)
+    b_norm = norm(b) or 1.0
+    for cycle in range(1, kMGCycles + 1):
+        mg_cycle(0, x, b)
+        residual(x, b, mg_r[0], N)
+        res = norm(mg_r[0]) / b_norm
+        if res <= kMGTolerance:
+            break
+    return cycle, res
+
+
+def precondition(r, z):
+    z.fill(0)
+    mg_cycle(0, z, r)
+
+
+def solve_mgpcg(x, b):
+    # returns (iterations, |residual| / |rhs|)
+    b_norm = norm(b) or 1.0
+    residual(x, b, cg_r, N)
+    res = norm(cg_r) / b_norm
+    if res <= kPCGTolerance:
+        return 0, res
+    precondition(cg_r, cg_z)
+    xpay(cg_p, cg_z, 0.0)
+    rz = dot(cg_r, cg_z)
+    for it in range(1, kPCGMaxIterations + 1):
+        apply_laplacian(cg_p, cg_q)
+        alpha = rz / dot(cg_p, cg_q)
+        axpy(x, alpha, cg_p)
+        axpy(cg_r, -alpha, cg_q)
+        res = norm(cg_r) / b_norm
+        if res <= kPCGTolerance:
+            break
+        precondition(cg_r, cg_z)
+        rz, rz_old = dot(cg_r, cg_z), rz
+        xpay(cg_p, cg_z, rz / rz_old)
+    return it, res
+
+
+stats = dict(frames=0, iterations=0, seconds=0.0, residual=0.0)
+
+
+def report():
+    frames = stats['frames']
+    print(f'{kPressureSolver}: '
+          f'{stats["iterations"] / frames:.1f} iterations, '
+          f'residual {stats["residual"]:.1e}, '
+          f'{stats["seconds"] / frames * 1000:.2f} ms/frame')
+    stats.update(frames=0, iterations=0, seconds=0.0)
+
+
+def project():
+    divergence(vel.old)
+    ti.sync()
+    t0 = time.perf_counter()
+    pressure_rhs(mg_b[0])
+    if kPressureSolver == 'jacobi':
+        pressure_jacobi(pre.old, pre.new)
+        iterations = kJacobiIterations
+    else:
+        solve = solve_mgpcg if kPressureSolver == 'mgpcg' else solve_multigrid
+        iterations, res = solve(pre.old, mg_b[0])
+    ti.sync()
+    stats['frames'] += 1
+    stats['iterations'] += iterations
+    stats['seconds'] += time.perf_counter() - t0
+    if kPressureSolver == 'jacobi':
+        # same system, so the residual is comparable across backends
+        residual(pre.old, mg_b[0], mg_r[0], N)
+        res = norm(mg_r[0]) / (norm(mg_b[0]) or 1.0)
+    stats['residual'] = res
     sub_grad(vel.old, pre.old)
 
 
+def substep():
+    advect_carried(vel.old)
+    for q in carried:
+        q.swap()
+    project()
+
+
 @ti.kernel
 def drag(dye: ti.template(), vel: ti.template(),
             mx: ti.f32, my: ti.f32, dx: ti.f32, dy: ti.f32):
@@ -110,6 +358,8 @@ while gui.running:
     px, py = mx, my
 
     substep()
+    if kReportEvery and stats['frames'] >= kReportEvery:
+        report()
     gui.set_image(dye.old)
     #gui.set_image(cmap(dye.old.to_numpy()))
     gui.show()
@@ -0,0 +1,93 @@
+'''
+Derivative kernels d^(k-j)/dx^(k-j) d^j/dy^j g(x, y) up to any order,
+generated with SymPy (what Untitled.ipynb did by hand) and cached on disk
+as plain Python, so loading them later doesn't import SymPy at all.
+
+Each generated module has, for k <= ORDER and j <= k in that order:
+    derivatives_np(x, y) -> list of NumPy arrays
+    derivatives_ti(p)    -> ti.Vector, a @ti.func taking a 2D position
+'''
+import hashlib
+import importlib.util
+import os
+
+KERNELS = {
+    'x_over_r': 'x / sqrt(x**2 + y**2)',
+    'inv_r': '1 / sqrt(x**2 + y**2)',
+    'log_r': 'log(sqrt(x**2 + y**2))',
+}
+kCacheDir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         '__kernelcache__')
+
+
+def generate(kernel, order):
+    import sympy as sp
+    from sympy.printing.pycode import PythonCodePrinter
+
+    class Printer(PythonCodePrinter):
+        def __init__(self, module):
+            super().__init__()
+            self.module = module
+
+        def _module_format(self, fqn, register=True):
+            return self.module + '.' + fqn.split('.')[-1]
+
+    x, y = sp.symbols('x y', real=True)
+    r = sp.Symbol('r', positive=True)
+    g = sp.sympify(KERNELS[kernel], locals=dict(x=x, y=y))
+    index = [(k, j) for k in range(order + 1) for j in range(k + 1)]
+    # writing x^2 + y^2 as r^2 turns every (x^2 + y^2)^(k/2) into r^k,
+    # which cse then shares across all the derivatives
+    exprs = [sp.diff(g, x, k - j, y, j).subs(x**2 + y**2, r**2)
+             for k, j in index]
+    temps, exprs = sp.cse(exprs, symbols=sp.numbered_symbols('t'))
+
+    def body(module):
+        printer = Printer(module)
+        lines = [f'r = {module}.sqrt(x**2 + y**2)']
+        lines += [f'{t} = {printer.doprint(e)}' for t, e in temps]
+        return lines, [printer.doprint(e) for e in exprs]
+
+    np_lines, np_exprs = body('np')
+    ti_lines, ti_exprs = body('ti')
+    out = [
+        f'# generated by kernelgen.py: {KERNELS[kernel]}, order {order}',
+        'import numpy as np',
+        'import taichi as ti',
+        '',
+        f'ORDER = {order}',
+        f'INDEX = {index}',
+        '',
+        '',
+        'def derivatives_np(x, y):',
+    ]
+    out += ['    ' + line for line in np_lines]
+    out += ['    return [', *[f'        {e},' for e in np_exprs], '    ]']
+    out += ['', '', '@ti.func', 'def derivatives_ti(p):']
+    out += ['    x = p[0]', '    y = p[1]']
+    out += ['    ' + line for line in ti_lines]
+    out += ['    return ti.Vector([', *[f'        {e},' for e in ti_exprs],
+            '    ])', '']
+    return '\n'.join(out)
+
+
+def load(kernel, order):
+    # the cache key covers the kernel expression, so editing KERNELS
+    # regenerates instead of loading stale code
+    digest = hashlib.sha1(f'{KERNELS[kernel]}:{order}'.encode()).hexdigest()
+    path = os.path.join(kCacheDir, f'{kernel}_{order}_{digest[:8]}.py')
+    if not os.path.exists(path):
+        os.makedirs(kCacheDir, exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            f.write(generate(kernel, order))
+        os.replace(path + '.tmp', path)
+    spec = importlib.util.spec_from_file_location(f'{kernel}_{order}', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+if __name__ == '__main__':
+    import sys
+    kernel, order = sys.argv[1], int(sys.argv[2])
+    print(load(kernel, order).__file__)
@@ -40,6 +40,7 @@ L = 4
 RES = 512
 particles = Particle.var(N)
 image = ti.var(ti.f32, (RES, RES))
+energies = ti.var(ti.f32, N)
 
 nodes = Node.var()
 tree = ti.root.pointer(ti.i, 4 ** (L + 1))
@@ -86,6 +87,13 @@ def npow(x):
         d = tl.normalizePow(x, -2, 1e-3)
     return d
 
+@ti.func
+def npot(x):
+    d = 0.0
+    if any(x != 0):
+        d = tl.invLength(x)
+    return d
+
 
 ## Main Program
 @ti.kernel
@@ -144,6 +152,43 @@ def compute_grad(p):
 
     return acc
 
+@ti.func
+def compute_potential(p):
+    pot = 0.0
+
+    for ch in range(4):
+        i = 4 + ch
+        if not ti.is_active(tree, i):
+            continue
+        size_sqr = 1 / 4
+        npos = nodes[i].mpos / nodes[i].mass
+        np2p = npos - p
+        if tl.sqrLength(np2p) >= size_sqr:
+            pot += npot(np2p) * nodes[i].mass
+        else:
+            bas = (ch % 2) * 2 + (ch // 2) * 8
+            for ch_ in range(4):
+                i = 16 + bas + (ch_ % 2) + (ch_ // 2) * 4
+                if not ti.is_active(tree, i):
+                    continue
+                size_sqr = 1 / 16
+                npos = nodes[i].mpos / nodes[i].mass
+                np2p = npos - p
+                if tl.sqrLength(np2p) >= size_sqr:
+                    pot += npot(np2p) * nodes[i].mass
+                else:
+                    baso = (ch % 2) * 4 + (ch // 2) * 8 * 4
+                    bas_ = (ch_ % 2) * 2 + (ch_ // 2) * 8 * 2
+                    for ch__ in range(4):
+                        i = 64 + baso + bas_ + (ch__ % 2) + (ch__ // 2) * 8
+                        if not ti.is_active(tree, i):
+                            continue
+                        npos = nodes[i].mpos / nodes[i].mass
+                        np2p = npos - p
+                        pot += npot(np2p) * nodes[i].mass
+
+    return pot
+
 @ti.kernel
 def render(mx: ti.f32, my: ti.f32):
     p = vec(mx, my)
@@ -162,15 +207,15 @@ def advance():
 
 
 @ti.kernel
-def compute_energy():
-    kine_eng = 0.0
-    pote_eng = 0.0
-    for i in range(N):
-        kine_eng += tl.sqrLength(particles.vel[i])
+def compute_energies():
+    # potential through the tree, one slot per particle, summed on the host
     for i in range(N):
-        for j in range(i):
-            pote_eng += tl.invLength(particles.pos[i] - particles.pos[j])
-    print(kine_eng * 0.5 - pote_eng)
+        pote = compute_potential(particles.pos[i])
+        energies[i] = 0.5 * (tl.sqrLength(particles.vel[i]) - pote)
+
+def compute_energy():
+    compute_energies()
+    print(energies.to_numpy().sum(dtype='f8'))
 
 
 ## GUI Loop
@@ -1,5 +1,6 @@
 import taichi as ti
 import taichi_glsl as tl
+import stencil
 import matplotlib.cm as cm
 cmap = cm.get_cmap('magma')
 
@@ -11,18 +12,9 @@ y = ti.var(ti.f32, (N, N))
 b = ti.var(ti.i32, (N, N))
 
 
-links = [[-1, 0], [1, 0], [0, -1], [0, 1]]
-weights = [1, 1, 1, 1]
-links = [ti.Vector(_) for _ in links]
-@ti.kernel
-def possion(x: ti.template(), y: ti.template(), m: ti.template()):
-    for i in ti.grouped(x):
-        if b[i] != 0:
-            continue
-        avg = x[i] * 0
-        for dir, wei in ti.static(zip(links, weights)):
-            avg += wei * tl.sample(x, i + dir * m)
-        y[i] = avg / sum(weights)
+# (stride, sweeps) coarse to fine, each level one launch
+levels = [(32, 4), (16, 16), (8, 6), (4, 4), (2, 2), (1, 2)]
+levels = [stencil.Jacobi(N, k, m, mask=b) for m, k in levels]
 
 
 @ti.kernel
@@ -61,23 +53,7 @@ with ti.GUI('Possion Solver') as gui:
             press_b(*gui.get_cursor_pos())
         if gui.is_pressed(gui.RMB):
             press_x(*gui.get_cursor_pos())
-        for i in range(2):
-            possion(x, y, 32)
-            possion(y, x, 32)
-        for i in range(8):
-            possion(x, y, 16)
-            possion(y, x, 16)
-        for i in range(3):
-            possion(x, y, 8)
-            possion(y, x, 8)
-        for i in range(2):
-            possion(x, y, 4)
-            possion(y, x, 4)
-        for i in range(1):
-            possion(x, y, 2)
-            possion(y, x, 2)
-        for i in range(1):
-            possion(x, y, 1)
-            possion(y, x, 1)
+        for relax in levels:
+            relax(x, y)
         gui.set_image(cmap(x.to_numpy()))
         gui.show()
@@ -1,10 +1,11 @@
 import taichi as ti
 import taichi_glsl as tl
+import tables
 import random, math
 ti.init()#kernel_profiler=True)
 
 dt = 0.01
-kMaxParticles = 1024
+kMinParticles = 1024
 kResolution = 512
 kKernelSize = 16 / 512
 kKernelFactor = 0.5 / kKernelSize**2
@@ -16,15 +17,32 @@ kParticleColor = 0x068587
 kBoundaryColor = 0xebaca2
 kParticleDisplaySize = 0.2 * kKernelSize * kResolution
 
-particle_pos = ti.Vector(2, ti.f32, kMaxParticles)
-particle_vel = ti.Vector(2, ti.f32, kMaxParticles)
-property_vel = ti.Vector(2, ti.f32, kMaxParticles)
-property_density = ti.var(ti.f32, kMaxParticles)
-property_force = ti.Vector(2, ti.f32, kMaxParticles)
-n_particles = ti.var(ti.i32, ())
 
-if kUseImage:
-    image = ti.Vector(3, ti.f32, (kResolution, kResolution))
+def allocate_particles(capacity):
+    global kMaxParticles, particle_pos, particle_vel, property_vel
+    global property_density, property_force, n_particles, image
+    kMaxParticles = capacity
+    particle_pos = ti.Vector(2, ti.f32, kMaxParticles)
+    particle_vel = ti.Vector(2, ti.f32, kMaxParticles)
+    property_vel = ti.Vector(2, ti.f32, kMaxParticles)
+    property_density = ti.var(ti.f32, kMaxParticles)
+    property_force = ti.Vector(2, ti.f32, kMaxParticles)
+    n_particles = ti.var(ti.i32, ())
+
+    if kUseImage:
+        image = ti.Vector(3, ti.f32, (kResolution, kResolution))
+    return particle_pos, particle_vel
+
+
+def resize_particles(capacity):
+    count = n_particles[None]
+    if capacity != kMaxParticles:
+        tables.reallocate(capacity, count, (particle_pos, particle_vel),
+                          allocate_particles)
+        n_particles[None] = count
+
+
+allocate_particles(kMinParticles)
 
 
 @ti.func
@@ -127,10 +145,18 @@ while gui.running:
             else:
                 mouse = tl.vec(*gui.get_cursor_pos())
                 diff = (mouse - last_mouse) * 2.0
+                resize_particles(
+                    tables.grow(kMaxParticles, n_particles[None] + 1))
                 add_particle_at(mouse.x, mouse.y, diff.x, diff.y)
         elif e.key == 'r':
             a = random.random() * math.tau
+            resize_particles(
+                tables.grow(kMaxParticles, n_particles[None] + 1))
             add_particle_at(math.cos(a) * 0.4 + 0.5, math.sin(a) * 0.4 + 0.5, 0, 0)
+        elif e.key == 'c':
+            n_particles[None] = 0
+            resize_particles(tables.shrink(kMaxParticles, n_particles[None],
+                                           kMinParticles))
 
     substep()
     if kUseImage:
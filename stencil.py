@@ -0,0 +1,252 @@
+'''
+Tiled stencils on an n x n grid.  apply(grid, op, x, y) runs
+
+    op(grid, P, edge, x, y)
+
+for every cell P, walking the grid in tile x tile blocks.  Reads go through
+at(grid, Q, edge), which clamps to the grid like tl.sample does, but only
+in tiles within grid.reach of the border; every other tile is compiled
+with edge=False and indexes directly.
+
+Jacobi is the 4-point averaging stencil the solvers here share,
+
+    y[P] = (x[P - s ex] + x[P + s ex] + x[P - s ey] + x[P + s ey]) / 4 - rhs[P]
+
+with cells where mask[P] != 0 held fixed.  A Jacobi object runs all its
+sweeps in one kernel launch; when blocked, each tile loads itself plus a
+halo, does several sweeps on that copy while it is still in cache, and
+writes back only its core.
+'''
+import taichi as ti
+import taichi_glsl as tl
+
+kTile = 32
+kBlockSweeps = 4  # sweeps per tile visit, the halo is this times the stride
+
+
+class Grid:
+    def __init__(self, n, reach=1, tile=kTile):
+        # reach: how far from P an op reads
+        self.n = n
+        self.reach = reach
+        self.tile = tile
+        self.tiles = -(-n // tile)
+
+
+class Jacobi(Grid):
+    def __init__(self, n, sweeps, stride=1, rhs=None, mask=None,
+                 blocked=None, tile=kTile, block_sweeps=kBlockSweeps):
+        # even sweep counts only, so the result always lands back in x
+        assert sweeps % 2 == 0
+        if blocked is None:
+            blocked = stride * block_sweeps <= tile // 4
+        super().__init__(n, stride, tile)
+        self.sweeps = sweeps
+        self.stride = stride
+        self.rhs = rhs
+        self.mask = mask
+        self.blocked = blocked
+        if not blocked:
+            self.rounds = [1] * sweeps
+            return
+        # split the sweeps into an even number of near-equal tile visits
+        count = 2 * -(-sweeps // (2 * block_sweeps))
+        self.rounds = [sweeps // count + (r < sweeps % count)
+                       for r in range(count)]
+        self.halo = max(self.rounds) * stride
+        self.width = tile + 2 * self.halo
+        self.buf = ti.var(ti.f32, (self.tiles**2, 2, self.width, self.width))
+
+    def __call__(self, x, y):
+        # every sweep, x -> y -> x ...; the result is in x, y is scratch
+        relax(self, x, y)
+
+
+@ti.func
+def inside(P, n):
+    return (P.x >= 0) & (P.x < n) & (P.y >= 0) & (P.y < n)
+
+
+@ti.func
+def at(g: ti.template(), P, edge: ti.template()):
+    Q = P
+    if ti.static(edge):
+        Q = tl.clamp(P, 0, g.n - 1)
+    return Q
+
+
+@ti.func
+def tile_origin(g: ti.template(), t):
+    return tl.vec(t % g.tiles, t // g.tiles) * g.tile
+
+
+@ti.func
+def interior(g: ti.template(), lo, reach):
+    # whether the tile at lo and everything within reach of it is in-grid
+    hi = lo + g.tile + reach
+    return (lo.x >= reach) & (lo.y >= reach) & (hi.x <= g.n) & (hi.y <= g.n)
+
+
+@ti.func
+def visit_tile(g: ti.template(), op: ti.template(), t,
+               x: ti.template(), y: ti.template()):
+    lo = tile_origin(g, t)
+    if interior(g, lo, g.reach):
+        for u in range(g.tile):
+            for v in range(g.tile):
+                op(g, lo + tl.vec(u, v), False, x, y)
+    else:
+        for u in range(g.tile):
+            for v in range(g.tile):
+                P = lo + tl.vec(u, v)
+                if inside(P, g.n):
+                    op(g, P, True, x, y)
+
+
+@ti.kernel
+def apply(g: ti.template(), op: ti.template(),
+          x: ti.template(), y: ti.template()):
+    for t in range(g.tiles * g.tiles):
+        visit_tile(g, op, t, x, y)
+
+
+@ti.func
+def update(s: ti.template(), P, center, total):
+    res = total * 0.25
+    if ti.static(s.rhs is not None):
+        res -= s.rhs[P]
+    if ti.static(s.mask is not None):
+        if s.mask[P] != 0:
+            res = center
+    return res
+
+
+@ti.func
+def jacobi_at(s: ti.template(), P, edge: ti.template(),
+              x: ti.template(), y: ti.template()):
+    total = 0.0
+    for d in ti.static([(-1, 0), (1, 0), (0, -1), (0, 1)]):
+        total += x[at(s, P + tl.vec(*d) * s.stride, edge)]
+    y[P] = update(s, P, x[P], total)
+
+
+@ti.func
+def load_tile(s: ti.template(), t, lo, src: ti.template(),
+              edge: ti.template()):
+    for u in range(s.width):
+        for v in range(s.width):
+            s.buf[t, 0, u, v] = src[at(s, lo + tl.vec(u, v), edge)]
+
+
+@ti.func
+def sweep_tile(s: ti.template(), t, lo, src, dst, margin,
+               edge: ti.template()):
+    # buf[t, dst] = one sweep of buf[t, src] over [margin, width - margin)^2;
+    # neighbours clamp to the grid first, which keeps them in the window
+    for u in range(margin, s.width - margin):
+        for v in range(margin, s.width - margin):
+            P = lo + tl.vec(u, v)
+            ok = 1
+            if ti.static(edge):
+                ok = inside(P, s.n)
+            if ok:
+                total = 0.0
+                for d in ti.static([(-1, 0), (1, 0), (0, -1), (0, 1)]):
+                    J = at(s, P + tl.vec(*d) * s.stride, edge) - lo
+                    total += s.buf[t, src, J.x, J.y]
+                s.buf[t, dst, u, v] = update(s, P, s.buf[t, src, u, v], total)
+
+
+@ti.func
+def store_tile(s: ti.template(), t, lo, dst: ti.template(), slot,
+               edge: ti.template()):
+    for u in range(s.tile):
+        for v in range(s.tile):
+            P = lo + s.halo + tl.vec(u, v)
+            ok = 1
+            if ti.static(edge):
+                ok = inside(P, s.n)
+            if ok:
+                dst[P] = s.buf[t, slot, u + s.halo, v + s.halo]
+
+
+@ti.func
+def sweep_window(s: ti.template(), t, lo, rounds: ti.template(),
+                 edge: ti.template()):
+    # each sweep shrinks the valid window by one stride, the last one
+    # computes just the core
+    for k in ti.static(range(rounds)):
+        margin = s.halo - (rounds - 1 - k) * s.stride
+        sweep_tile(s, t, lo, k % 2, (k + 1) % 2, margin, edge)
+
+
+@ti.kernel
+def relax(s: ti.template(), x: ti.template(), y: ti.template()):
+    for r in ti.static(range(len(s.rounds))):
+        src = ti.static((x, y)[r % 2])
+        dst = ti.static((y, x)[r % 2])
+        if ti.static(s.blocked):
+            for t in range(s.tiles * s.tiles):
+                lo = tile_origin(s, t) - s.halo
+                slot = s.rounds[r] % 2
+                if interior(s, lo + s.halo, s.halo):
+                    load_tile(s, t, lo, src, False)
+                    sweep_window(s, t, lo, s.rounds[r], False)
+                    store_tile(s, t, lo, dst, slot, False)
+                else:
+                    load_tile(s, t, lo, src, True)
+                    sweep_window(s, t, lo, s.rounds[r], True)
+                    store_tile(s, t, lo, dst, slot, True)
+        else:
+            for t in range(s.tiles * s.tiles):
+                visit_tile(s, jacobi_at, t, src, dst)
+
+
+@ti.kernel
+def step(s: ti.template(), x: ti.template(), y: ti.template()):
+    # a single sweep x -> y, what the solvers used to launch per iteration
+    for P in ti.grouped(y):
+        total = 0.0
+        for d in ti.static([(-1, 0), (1, 0), (0, -1), (0, 1)]):
+            total += tl.sample(x, P + tl.vec(*d) * s.stride)
+        y[P] = update(s, P, x[P], total)
+
+
+if __name__ == '__main__':
+    # possion.py / gravity.py sized problem: fixed border, 30 sweeps
+    import time
+    import numpy as np
+
+    N, K = 512, 30
+    x = ti.var(ti.f32, (N, N))
+    y = ti.var(ti.f32, (N, N))
+    b = ti.var(ti.i32, (N, N))
+    fused = Jacobi(N, K, mask=b, blocked=False)
+    blocked = Jacobi(N, K, mask=b, blocked=True)
+
+    init = np.random.default_rng(0).random((N, N), dtype=np.float32)
+    border = np.zeros((N, N), np.int32)
+    border[[0, -1], :] = border[:, [0, -1]] = 1
+    b.from_numpy(border)
+
+    def per_launch():
+        for _ in range(K // 2):
+            step(fused, x, y)
+            step(fused, y, x)
+
+    results = {}
+    for name, run in [('per-launch', per_launch),
+                      ('fused', lambda: fused(x, y)),
+                      ('blocked', lambda: blocked(x, y))]:
+        best = float('inf')
+        for _ in range(5):
+            x.from_numpy(init)
+            ti.sync()
+            t0 = time.perf_counter()
+            run()
+            ti.sync()
+            best = min(best, time.perf_counter() - t0)
+        results[name] = x.to_numpy()
+        err = np.abs(results[name] - results['per-launch']).max()
+        print(f'{name:>10}: {best * 1000:7.2f} ms for {K} sweeps, '
+              f'max diff {err:.1e}')
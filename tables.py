@@ -0,0 +1,41 @@
+'''
+Growable particle tables.  Taichi can't resize a materialized field, so
+growing or shrinking one means saving the live rows, calling ti.init()
+again, declaring every field afresh at the new capacity and copying the
+rows back; kernels recompile against the new globals on their next launch.
+
+    capacity = tables.grow(kMaxParticles, count)
+    capacity = tables.shrink(kMaxParticles, count, kMinParticles)
+    tables.reallocate(capacity, count, fields, allocate)
+
+allocate(capacity) declares the fields and returns the ones to carry over,
+in the same order as fields.  Counters and other scalars are the caller's
+to restore.
+'''
+import taichi as ti
+import numpy as np
+
+kGrowThreshold = 0.9  # grow once the tables are this full
+kShrinkThreshold = 0.25  # shrink once the tables are this empty
+
+
+def grow(capacity, count, threshold=kGrowThreshold):
+    while count > capacity * threshold:
+        capacity *= 2
+    return capacity
+
+
+def shrink(capacity, count, minimum, threshold=kShrinkThreshold):
+    while capacity > minimum and count < capacity * threshold:
+        capacity //= 2
+    return capacity
+
+
+def reallocate(capacity, count, fields, allocate, init_args={}):
+    assert count <= capacity
+    saved = [field.to_numpy()[:count] for field in fields]
+    ti.init(**init_args)
+    for field, data in zip(allocate(capacity), saved):
+        padded = np.zeros((capacity, ) + data.shape[1:], data.dtype)
+        padded[:count] = data
+        field.from_numpy(padded)
@@ -0,0 +1,19 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip('taichi')
+pytest.importorskip('taichi_glsl')
+pytest.importorskip('matplotlib')
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.mark.parametrize('particles', [1000, 4096])
+def test_afmm_accuracy(particles):
+    # fmm.py --check asserts the afmm velocity error is below 1e-4 against
+    # the exact direct sum for every order p >= 8
+    subprocess.run([sys.executable, os.path.join(here, 'fmm.py'), '--check',
+                    '--particles', str(particles)], cwd=here, check=True)
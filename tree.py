@@ -1,51 +1,261 @@
-# N-body gravity simulation in 300 lines of Taichi, tree method, no multipole, O(N log N)
+# N-body gravity simulation in Taichi, tree method (quadtree or octree), O(N log N)
 # Author: archibate <1931127624@qq.com>, all left reserved
 import taichi as ti
 import taichi_glsl as tl
-ti.init()
+import numpy as np
+import tables
+import argparse
+import os
+import subprocess
+import sys
+import time
 
+parser = argparse.ArgumentParser(description='Tree-code N-body gravity')
+parser.add_argument('--bench-build', action='store_true',
+                    help='benchmark serial vs parallel tree construction')
+parser.add_argument('--bench-force', action='store_true',
+                    help='time one tree force pass')
+parser.add_argument('--bench-threads', action='store_true',
+                    help='time the force pass for 1, 2, 4, ... CPU threads')
+parser.add_argument('--bench-bucket', action='store_true',
+                    help='sweep the leaf bucket size')
+parser.add_argument('--bench-reorder', action='store_true',
+                    help='time the force pass before and after reordering')
+parser.add_argument('--accuracy', action='store_true',
+                    help='report force error vs. cost per opening angle')
+parser.add_argument('--bench-scene', action='store_true',
+                    help='time full steps of a Plummer sphere')
+parser.add_argument('--dim', type=int, choices=[2, 3], default=2,
+                    help='2 for a quadtree, 3 for an octree')
+parser.add_argument('--particles', type=int, default=2**20,
+                    help='number of particles for --bench-scene/--headless')
+parser.add_argument('--headless', action='store_true',
+                    help='run without a GUI and report steps per second')
+parser.add_argument('--distribution', choices=['disk', 'uniform', 'plummer'],
+                    default='disk', help='initial particles for --headless')
+parser.add_argument('--steps', type=int, default=100,
+                    help='number of steps for --headless')
+parser.add_argument('--snapshot-every', type=int, default=0,
+                    help='write a snapshot every K steps, 0 for never')
+parser.add_argument('--output', default='snapshots',
+                    help='directory for --headless snapshots')
+parser.add_argument('--threads', type=int, default=None,
+                    help='limit the number of CPU threads')
+args = parser.parse_args()
+kBenchmark = (args.bench_build or args.bench_force or args.bench_threads
+              or args.bench_bucket or args.bench_reorder or args.bench_scene
+              or args.accuracy)
+
+kInitArgs = {}
+if args.threads is not None:
+    kInitArgs = dict(arch=ti.cpu, cpu_max_num_threads=args.threads)
+ti.init(**kInitArgs)
+
+kDim = args.dim
 kUseTree = True
+kParallelBuild = True
+kRefit = True  # refit node moments between rebuilds, needs kParallelBuild
+kRefitMaxEscaped = 0.01  # rebuild once this fraction left its leaf cell
+kRefitMaxSteps = 64  # rebuild at least this often
+kReorderInterval = 4  # sort particle_table by Morton key every N builds
+kBlockTimesteps = True  # per-particle power-of-two steps, see substep_block
+kMaxBin = 8  # bin b steps by kMaxTimestep / 2**b
+kTimestepAccuracy = 0.05  # eta in dt = eta * sqrt(softening length / |a|)
 #kDisplay = ['tree', 'mouse', 'pixels']
-kDisplay = ['pixels']
+kDisplay = ['pixels'] if not args.headless else []
 kResolution = 832
-kShapeFactor = 1
-kMaxParticles = 8192
-kMaxDepth = kMaxParticles * 1
-kMaxNodes = kMaxParticles * 4
+kOpeningAngle = 0.5  # initial value of opening_angle, can be changed live
+kUseQuadrupole = True  # allocate quadrupole moments, see use_quadrupole
+kSoftening = 1e-3
+kLeafCapacity = 8  # initial value of leaf_capacity, see --bench-bucket
+kMinParticles = 8192
+kMortonBits = 30 // kDim  # per axis, so that a key fits in a positive i32
+kMaxLevel = kMortonBits
+kChildren = 2**kDim
+kChildShape = [2] * kDim
+# child c of a node lies on the upper side of axis d iff bit kDim-1-d is set,
+# matching the order in which morton_key interleaves the axes
+kChildWhich = [[(c >> (kDim - 1 - d)) & 1 for d in range(kDim)]
+               for c in range(kChildren)]
+kZeroMatrix = [[0.0] * kDim for _ in range(kDim)]
+kIdentityMatrix = [[float(i == j) for j in range(kDim)] for i in range(kDim)]
+kStackSize = (kChildren - 1) * (kMaxLevel + 1) + 1
 
 dt = 0.00005
+kMaxTimestep = dt * 16
+kMinTimestep = kMaxTimestep / 2**kMaxBin
 LEAF = -1
 TREE = -2
 
-particle_mass = ti.var(ti.f32)
-particle_pos = ti.Vector(2, ti.f32)
-particle_vel = ti.Vector(2, ti.f32)
-particle_table = ti.root.dense(ti.i, kMaxParticles)
-particle_table.place(particle_pos).place(particle_vel).place(particle_mass)
-particle_table_len = ti.var(ti.i32, ())
-
-if kUseTree:
-    trash_particle_id = ti.var(ti.i32)
-    trash_base_parent = ti.var(ti.i32)
-    trash_base_geo_center = ti.Vector(2, ti.f32)
-    trash_base_geo_size = ti.var(ti.f32)
-    trash_table = ti.root.dense(ti.i, kMaxDepth)
-    trash_table.place(trash_particle_id)
-    trash_table.place(trash_base_parent, trash_base_geo_size)
-    trash_table.place(trash_base_geo_center)
-    trash_table_len = ti.var(ti.i32, ())
-
-    node_mass = ti.var(ti.f32)
-    node_weighted_pos = ti.Vector(2, ti.f32)
-    node_particle_id = ti.var(ti.i32)
-    node_children = ti.var(ti.i32)
-    node_table = ti.root.dense(ti.i, kMaxNodes)
-    node_table.place(node_mass, node_particle_id, node_weighted_pos)
-    node_table.dense(ti.jk, 2).place(node_children)
-    node_table_len = ti.var(ti.i32, ())
-
-if len(kDisplay):
-    display_image = ti.Vector(3, ti.f32, (kResolution, kResolution))
+
+def allocate_tables(particle_capacity, node_capacity=None):
+    # called again by tables.reallocate(), returns the fields carried over
+    global kMaxParticles, kMaxDepth, kMaxNodes, kSortSize, kStackLanes
+    global kAccuracySamples
+    global particle_mass, particle_pos, particle_vel, particle_table_len
+    global particle_external_id, particle_slot, particle_fields
+    global particle_mass_swap, particle_pos_swap, particle_vel_swap
+    global particle_external_id_swap, particle_acc_swap, particle_bin_swap
+    global particle_acc, particle_bin, active_list, active_len, deepest_bin
+    global particle_energy
+    global trash_particle_id, trash_base_parent, trash_base_geo_center
+    global trash_base_geo_size, trash_table_len
+    global node_mass, node_weighted_pos, node_particle_id, node_children
+    global node_table_len, node_quadrupole, node_begin, node_end
+    global opening_angle, use_quadrupole, leaf_capacity
+    global sort_key, sort_id, level_begin, level_end, tree_depth
+    global node_geo_center, node_geo_size, escaped_count
+    global built_particle_count
+    global stack_node, stack_geo_size, display_image, accuracy_error
+
+    kMaxParticles = particle_capacity
+    kMaxDepth = kMaxParticles * 1
+    kMaxNodes = node_capacity or kMaxParticles * 4
+    kSortSize = 1 << (kMaxParticles - 1).bit_length()
+    kStackLanes = min(kMaxParticles, 65536)
+    kAccuracySamples = min(1024, kStackLanes)
+
+    particle_mass = ti.var(ti.f32)
+    particle_pos = ti.Vector(kDim, ti.f32)
+    particle_vel = ti.Vector(kDim, ti.f32)
+    particle_table = ti.root.dense(ti.i, kMaxParticles)
+    particle_table.place(particle_pos).place(particle_vel).place(particle_mass)
+    particle_table_len = ti.var(ti.i32, ())
+
+    # reordering moves particles between slots; ids seen outside stay put
+    particle_external_id = ti.var(ti.i32)
+    particle_slot = ti.var(ti.i32)
+    particle_table.place(particle_external_id, particle_slot)
+
+    # block timesteps: last acceleration and bin, -1 for not yet started
+    particle_acc = ti.Vector(kDim, ti.f32)
+    particle_bin = ti.var(ti.i32)
+    particle_table.place(particle_acc, particle_bin)
+    active_list = ti.var(ti.i32, kMaxParticles)
+    active_len = ti.var(ti.i32, ())
+    deepest_bin = ti.var(ti.i32, ())
+
+    # energy diagnostic scratch, one slot per particle so the sum needs no
+    # shared accumulator
+    particle_energy = ti.var(ti.f32)
+    particle_table.place(particle_energy)
+
+    particle_fields = (particle_pos, particle_vel, particle_mass,
+                       particle_external_id, particle_slot, particle_acc,
+                       particle_bin)
+
+    particle_mass_swap = ti.var(ti.f32)
+    particle_pos_swap = ti.Vector(kDim, ti.f32)
+    particle_vel_swap = ti.Vector(kDim, ti.f32)
+    particle_external_id_swap = ti.var(ti.i32)
+    particle_acc_swap = ti.Vector(kDim, ti.f32)
+    particle_bin_swap = ti.var(ti.i32)
+    ti.root.dense(ti.i, kMaxParticles).place(particle_pos_swap,
+                                              particle_vel_swap,
+                                              particle_mass_swap,
+                                              particle_external_id_swap,
+                                              particle_acc_swap,
+                                              particle_bin_swap)
+
+    # a child cell is accepted when its size / distance < opening_angle
+    opening_angle = ti.var(ti.f32, ())
+    use_quadrupole = ti.var(ti.i32, ())
+    # leaves hold up to this many particles, summed directly by traversal
+    leaf_capacity = ti.var(ti.i32, ())
+
+    if kUseTree:
+        trash_particle_id = ti.var(ti.i32)
+        trash_base_parent = ti.var(ti.i32)
+        trash_base_geo_center = ti.Vector(kDim, ti.f32)
+        trash_base_geo_size = ti.var(ti.f32)
+        trash_table = ti.root.dense(ti.i, kMaxDepth)
+        trash_table.place(trash_particle_id)
+        trash_table.place(trash_base_parent, trash_base_geo_size)
+        trash_table.place(trash_base_geo_center)
+        trash_table_len = ti.var(ti.i32, ())
+
+        node_mass = ti.var(ti.f32)
+        node_weighted_pos = ti.Vector(kDim, ti.f32)
+        node_particle_id = ti.var(ti.i32)
+        node_children = ti.var(ti.i32)
+        node_table = ti.root.dense(ti.i, kMaxNodes)
+        node_table.place(node_mass, node_particle_id, node_weighted_pos)
+        node_table.dense(ti.indices(*range(1, kDim + 1)),
+                         2).place(node_children)
+        node_table_len = ti.var(ti.i32, ())
+
+        # traceless quadrupole about the node's center of mass
+        if kUseQuadrupole:
+            node_quadrupole = ti.Matrix(kDim, kDim, ti.f32)
+            node_table.place(node_quadrupole)
+
+        # parallel builder: particles sorted by Morton key, nodes own a range
+        sort_key = ti.var(ti.i32, kSortSize)
+        sort_id = ti.var(ti.i32, kSortSize)
+        node_begin = ti.var(ti.i32)
+        node_end = ti.var(ti.i32)
+        node_table.place(node_begin, node_end)
+        level_begin = ti.var(ti.i32, kMaxLevel + 2)
+        level_end = ti.var(ti.i32, kMaxLevel + 2)
+        tree_depth = 0
+
+        # refit: cell boxes kept to detect particles escaping their leaf
+        node_geo_center = ti.Vector(kDim, ti.f32)
+        node_geo_size = ti.var(ti.f32)
+        node_table.place(node_geo_center, node_geo_size)
+        escaped_count = ti.var(ti.i32, ())
+        built_particle_count = -1  # no topology to refit yet
+
+        # private traversal stacks, one per particle of a kStackLanes batch
+        stack_node = ti.var(ti.i32)
+        stack_geo_size = ti.var(ti.f32)
+        ti.root.dense(ti.ij, (kStackLanes, kStackSize)).place(
+            stack_node, stack_geo_size)
+
+    if len(kDisplay):
+        display_image = ti.Vector(3, ti.f32, (kResolution, kResolution))
+
+    if kBenchmark:
+        accuracy_error = ti.var(ti.f32, kAccuracySamples)
+
+    return particle_fields
+
+
+def reallocate_tables(particle_capacity, node_capacity=None):
+    count = particle_table_len[None]
+    theta, quadrupole = opening_angle[None], use_quadrupole[None]
+    bucket = leaf_capacity[None]
+
+    tables.reallocate(particle_capacity, count, particle_fields,
+                      lambda capacity: allocate_tables(capacity, node_capacity),
+                      kInitArgs)
+
+    particle_table_len[None] = count
+    opening_angle[None], use_quadrupole[None] = theta, quadrupole
+    leaf_capacity[None] = bucket
+
+
+def reserve_particles(count):
+    capacity = tables.grow(kMaxParticles, count)
+    if capacity != kMaxParticles:
+        reallocate_tables(capacity, max(kMaxNodes, capacity * 4))
+
+
+def reserve_nodes(count):
+    # nodes are reserved for an exact upcoming split, no headroom needed
+    capacity = tables.grow(kMaxNodes, count, 1.0)
+    if capacity != kMaxNodes:
+        reallocate_tables(kMaxParticles, capacity)
+
+
+def shrink_tables():
+    capacity = tables.shrink(kMaxParticles, particle_table_len[None],
+                             kMinParticles)
+    if capacity != kMaxParticles:
+        reallocate_tables(capacity)
+
+
+allocate_tables(kMinParticles)
 
 
 @ti.func
@@ -55,7 +265,9 @@ def alloc_node():
     node_mass[ret] = 0
     node_weighted_pos[ret] = particle_pos[0] * 0
     node_particle_id[ret] = LEAF
-    for which in ti.grouped(ti.ndrange(2, 2)):
+    if ti.static(kUseQuadrupole):
+        node_quadrupole[ret] = ti.Matrix(kZeroMatrix)
+    for which in ti.grouped(ti.ndrange(*kChildShape)):
         node_children[ret, which] = LEAF
     return ret
 
@@ -67,6 +279,10 @@ def alloc_particle():
     particle_mass[ret] = 0
     particle_pos[ret] = particle_pos[0] * 0
     particle_vel[ret] = particle_pos[0] * 0
+    particle_external_id[ret] = ret
+    particle_slot[ret] = ret
+    particle_acc[ret] = particle_pos[0] * 0
+    particle_bin[ret] = -1
     return ret
 
 
@@ -122,9 +338,30 @@ def alloc_a_node_for_particle(particle_id, parent, parent_geo_center,
     node_mass[parent] = mass
 
 
+@ti.func
+def screen_to_world(mx, my):
+    ret = particle_pos[0] * 0
+    if ti.static(kDim == 2):
+        ret = tl.vec(mx, my)
+    else:
+        ret = tl.vec(mx, my, 0.5)
+    return ret
+
+
+@ti.func
+def random_in_ball():
+    ret = particle_pos[0] * 0
+    if ti.static(kDim == 2):
+        ret = tl.randSolid2D()
+    else:
+        ret = tl.randUnit3D() * ti.random()**(1 / 3)
+    return ret
+
+
 @ti.kernel
 def add_particle_at(mx: ti.f32, my: ti.f32, mass: ti.f32):
-    mouse_pos = tl.vec(mx, my) + tl.randND(2) * (0.05 / kResolution)
+    mouse_pos = screen_to_world(mx, my) + tl.randND(kDim) * (0.05 /
+                                                             kResolution)
 
     particle_id = alloc_particle()
     particle_pos[particle_id] = mouse_pos
@@ -135,12 +372,20 @@ def add_particle_at(mx: ti.f32, my: ti.f32, mass: ti.f32):
 def add_random_particles():
     num = ti.static(1)
     particle_id = alloc_particle()
-    particle_pos[particle_id] = tl.randSolid2D() * 0.2 + 0.5
+    particle_pos[particle_id] = random_in_ball() * 0.2 + 0.5
     particle_mass[particle_id] = tl.randRange(0.0, 1.5)
 
 
 @ti.kernel
-def build_tree():
+def add_random_particles_n(num: ti.i32):
+    for i in range(num):
+        particle_id = alloc_particle()
+        particle_pos[particle_id] = random_in_ball() * 0.2 + 0.5
+        particle_mass[particle_id] = tl.randRange(0.0, 1.5)
+
+
+@ti.kernel
+def build_tree_serial():
     node_table_len[None] = 0
     trash_table_len[None] = 0
     alloc_node()
@@ -161,52 +406,401 @@ def build_tree():
         trash_table_len[None] = 0
         particle_id = particle_id + 1
 
+    # give each single-particle leaf a range so traversal can walk it
+    for node in range(node_table_len[None]):
+        if node_particle_id[node] >= 0:
+            k = ti.atomic_add(trash_table_len[None], 1)
+            sort_id[k] = node_particle_id[node]
+            node_begin[node] = k
+            node_end[node] = k + 1
+
+
+@ti.func
+def spread_bits(x):
+    # insert kDim - 1 zero bits between each of the low kMortonBits bits
+    if ti.static(kDim == 2):
+        x = (x | (x << 8)) & 0x00ff00ff
+        x = (x | (x << 4)) & 0x0f0f0f0f
+        x = (x | (x << 2)) & 0x33333333
+        x = (x | (x << 1)) & 0x55555555
+    else:
+        x = (x | (x << 16)) & 0x030000ff
+        x = (x | (x << 8)) & 0x0300f00f
+        x = (x | (x << 4)) & 0x030c30c3
+        x = (x | (x << 2)) & 0x09249249
+    return x
+
+
+@ti.func
+def morton_key(position):
+    cell = tl.clamp(int(position * (1 << kMortonBits)), 0,
+                    (1 << kMortonBits) - 1)
+    key = 0
+    for d in ti.static(range(kDim)):
+        key = key | (spread_bits(cell[d]) << (kDim - 1 - d))
+    return key
+
+
+@ti.kernel
+def compute_morton_keys(sort_len: ti.i32):
+    for i in range(sort_len):
+        if i < particle_table_len[None]:
+            sort_key[i] = morton_key(particle_pos[i])
+        else:
+            sort_key[i] = 0x7fffffff  # padding sinks to the end
+        sort_id[i] = i
+
+
+@ti.kernel
+def bitonic_step(sort_len: ti.i32, j: ti.i32, k: ti.i32):
+    for i in range(sort_len):
+        other = i ^ j
+        if other > i:
+            key_i = sort_key[i]
+            key_other = sort_key[other]
+            need_swap = key_i < key_other
+            if (i & k) == 0:
+                need_swap = key_i > key_other
+            if need_swap:
+                sort_key[i] = key_other
+                sort_key[other] = key_i
+                id_i = sort_id[i]
+                sort_id[i] = sort_id[other]
+                sort_id[other] = id_i
+
+
+def sort_particles_by_key():
+    sort_len = 1 << max(0, particle_table_len[None] - 1).bit_length()
+    compute_morton_keys(sort_len)
+    k = 2
+    while k <= sort_len:
+        j = k // 2
+        while j > 0:
+            bitonic_step(sort_len, j, k)
+            j //= 2
+        k *= 2
+
+
+@ti.func
+def lower_bound_digit(begin, end, shift, digit):
+    lo = begin
+    hi = end
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if ((sort_key[mid] >> shift) & (kChildren - 1)) < digit:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+@ti.kernel
+def emit_root():
+    node_table_len[None] = 0
+    root = alloc_node()
+    count = particle_table_len[None]
+    node_begin[root] = 0
+    node_end[root] = count
+    node_geo_center[root] = particle_pos[0] * 0 + 0.5
+    node_geo_size[root] = 1.0
+    if count > leaf_capacity[None]:
+        node_particle_id[root] = TREE
+    elif count > 0:
+        node_particle_id[root] = sort_id[0]
+    level_begin[0] = 0
+    level_end[0] = 1
+
+
+@ti.kernel
+def emit_level(level: ti.i32):
+    shift = kDim * (kMortonBits - 1 - level)
+    for parent in range(level_begin[level], level_end[level]):
+        if node_particle_id[parent] != TREE:
+            continue
+        begin = node_begin[parent]
+        end = node_end[parent]
+        child_geo_size = node_geo_size[parent] * 0.5
+        child_begin = begin
+        for c in ti.static(range(kChildren)):
+            child_end = end
+            if ti.static(c + 1 < kChildren):
+                child_end = lower_bound_digit(child_begin, end, shift, c + 1)
+            if child_end > child_begin:
+                child = alloc_node()
+                node_begin[child] = child_begin
+                node_end[child] = child_end
+                which = ti.Vector(kChildWhich[c])
+                node_geo_center[child] = node_geo_center[parent] + (
+                    which - 0.5) * child_geo_size
+                node_geo_size[child] = child_geo_size
+                if (child_end - child_begin <= leaf_capacity[None]) | (
+                        level + 1 == kMaxLevel):
+                    node_particle_id[child] = sort_id[child_begin]
+                else:
+                    node_particle_id[child] = TREE
+                node_children[parent, which] = child
+            child_begin = child_end
+
+
+@ti.func
+def quadrupole_of(offset, mass):
+    return mass * (3 * offset.outer_product(offset) -
+                   offset.norm_sqr() * ti.Matrix(kIdentityMatrix))
+
+
+@ti.func
+def accumulate_quadrupole(node):
+    quadrupole = ti.Matrix(kZeroMatrix)
+    if node_mass[node] > 0:
+        center = node_weighted_pos[node] / node_mass[node]
+        if node_particle_id[node] >= 0:
+            for k in range(node_begin[node], node_end[node]):
+                particle_id = sort_id[k]
+                quadrupole += quadrupole_of(particle_pos[particle_id] - center,
+                                            particle_mass[particle_id])
+        else:
+            for which in ti.grouped(ti.ndrange(*kChildShape)):
+                child = node_children[node, which]
+                if child != LEAF:
+                    if node_mass[child] > 0:
+                        child_center = node_weighted_pos[child] / node_mass[
+                            child]
+                        quadrupole += node_quadrupole[child] + quadrupole_of(
+                            child_center - center, node_mass[child])
+    node_quadrupole[node] = quadrupole
+
+
+@ti.kernel
+def accumulate_level(level: ti.i32):
+    for node in range(level_begin[level], level_end[level]):
+        mass = 0.0
+        weighted_pos = particle_pos[0] * 0
+        if node_particle_id[node] >= 0:
+            for k in range(node_begin[node], node_end[node]):
+                particle_id = sort_id[k]
+                mass += particle_mass[particle_id]
+                weighted_pos += particle_mass[particle_id] * particle_pos[
+                    particle_id]
+        else:
+            for which in ti.grouped(ti.ndrange(*kChildShape)):
+                child = node_children[node, which]
+                if child != LEAF:
+                    mass += node_mass[child]
+                    weighted_pos += node_weighted_pos[child]
+        node_mass[node] = mass
+        node_weighted_pos[node] = weighted_pos
+        if ti.static(kUseQuadrupole):
+            accumulate_quadrupole(node)
+
+
+def build_tree_parallel():
+    global tree_depth, built_particle_count
+    sort_particles_by_key()
+    emit_root()
+    depth = 0
+    while depth < kMaxLevel:
+        # each node of this level may emit up to kChildren children
+        width = level_end[depth] - level_begin[depth]
+        if node_table_len[None] + kChildren * width > kMaxNodes:
+            reserve_nodes(node_table_len[None] + kChildren * width)
+            return build_tree_parallel()
+        emit_level(depth)
+        begin, end = level_end[depth], node_table_len[None]
+        if begin == end:
+            break
+        level_begin[depth + 1] = begin
+        level_end[depth + 1] = end
+        depth += 1
+    tree_depth = depth
+    built_particle_count = particle_table_len[None]
+    refit_tree()
+
+
+def build_tree():
+    if kParallelBuild:
+        build_tree_parallel()
+    else:
+        build_tree_serial()
+
+
+@ti.kernel
+def count_escaped():
+    escaped_count[None] = 0
+    for node in range(node_table_len[None]):
+        if node_particle_id[node] >= 0:
+            half = node_geo_size[node] * 0.5
+            lower = node_geo_center[node] - half
+            upper = node_geo_center[node] + half
+            for k in range(node_begin[node], node_end[node]):
+                position = particle_pos[sort_id[k]]
+                escaped = 0
+                for d in ti.static(range(kDim)):
+                    if (position[d] < lower[d]) | (position[d] > upper[d]):
+                        escaped = 1
+                escaped_count[None] += escaped
+
+
+def refit_tree():
+    # same topology, node moments recomputed bottom-up from the leaves
+    for level in reversed(range(tree_depth + 1)):
+        accumulate_level(level)
+
+
+@ti.kernel
+def reorder_particles():
+    # move particle k of the Morton order into slot k, so that a leaf's
+    # particles are contiguous in memory; the tree stays valid because
+    # its ranges index the sorted order, which becomes the identity
+    for k in range(particle_table_len[None]):
+        particle_id = sort_id[k]
+        particle_pos_swap[k] = particle_pos[particle_id]
+        particle_vel_swap[k] = particle_vel[particle_id]
+        particle_mass_swap[k] = particle_mass[particle_id]
+        particle_external_id_swap[k] = particle_external_id[particle_id]
+        particle_acc_swap[k] = particle_acc[particle_id]
+        particle_bin_swap[k] = particle_bin[particle_id]
+    for k in range(particle_table_len[None]):
+        particle_pos[k] = particle_pos_swap[k]
+        particle_vel[k] = particle_vel_swap[k]
+        particle_mass[k] = particle_mass_swap[k]
+        particle_external_id[k] = particle_external_id_swap[k]
+        particle_acc[k] = particle_acc_swap[k]
+        particle_bin[k] = particle_bin_swap[k]
+        particle_slot[particle_external_id_swap[k]] = k
+    for node in range(node_table_len[None]):
+        if node_particle_id[node] >= 0:
+            node_particle_id[node] = node_begin[node]
+    for k in range(particle_table_len[None]):
+        sort_id[k] = k
+
+
+refit_steps = 0
+build_count = 0
+
+
+def update_tree():
+    global refit_steps, build_count
+    count = particle_table_len[None]
+    need_build = (not kRefit or not kParallelBuild
+                  or built_particle_count != count
+                  or refit_steps >= kRefitMaxSteps)
+    if not need_build:
+        count_escaped()
+        need_build = escaped_count[None] > kRefitMaxEscaped * count
+    if need_build:
+        build_tree()
+        refit_steps = 0
+        build_count += 1
+        if kParallelBuild and kReorderInterval and (
+                build_count % kReorderInterval == 0):
+            reorder_particles()
+    else:
+        refit_tree()
+        refit_steps += 1
+
 
 @ti.func
 def gravity_func(distance):
-    return tl.normalizePow(distance, -2, 1e-3)
+    return tl.normalizePow(distance, -2, kSoftening)
 
 
 @ti.func
-def get_tree_gravity_at(position):
+def quadrupole_gravity_func(distance, quadrupole):
+    r2 = distance.norm_sqr() + kSoftening
+    qd = quadrupole @ distance
+    return (2.5 * distance.dot(qd) / r2 * distance - qd) * r2**-2.5
+
+
+@ti.func
+def get_tree_gravity_at(position, lane):
     acc = particle_pos[0] * 0
+    theta2 = opening_angle[None]**2
 
-    trash_table_len[None] = 0
-    trash_id = alloc_trash()
-    assert trash_id == 0
-    trash_base_parent[trash_id] = 0
-    trash_base_geo_size[trash_id] = 1.0
+    stack_node[lane, 0] = 0
+    stack_geo_size[lane, 0] = 1.0
+    stack_len = 1
 
-    trash_id = 0
-    while trash_id < trash_table_len[None]:
-        parent = trash_base_parent[trash_id]
-        parent_geo_size = trash_base_geo_size[trash_id]
+    while stack_len > 0:
+        stack_len = stack_len - 1
+        parent = stack_node[lane, stack_len]
+        parent_geo_size = stack_geo_size[lane, stack_len]
 
-        particle_id = node_particle_id[parent]
-        if particle_id >= 0:
-            distance = particle_pos[particle_id] - position
-            acc += particle_mass[particle_id] * gravity_func(distance)
+        if node_particle_id[parent] >= 0:
+            for k in range(node_begin[parent], node_end[parent]):
+                particle_id = sort_id[k]
+                distance = particle_pos[particle_id] - position
+                acc += particle_mass[particle_id] * gravity_func(distance)
 
         else:  # TREE or LEAF
-            for which in ti.grouped(ti.ndrange(2, 2)):
+            for which in ti.grouped(ti.ndrange(*kChildShape)):
                 child = node_children[parent, which]
                 if child == LEAF:
                     continue
                 node_center = node_weighted_pos[child] / node_mass[child]
                 distance = node_center - position
-                if distance.norm_sqr() > kShapeFactor**2 * parent_geo_size**2:
+                child_geo_size = parent_geo_size * 0.5
+                if distance.norm_sqr() * theta2 > child_geo_size**2:
                     acc += node_mass[child] * gravity_func(distance)
+                    if ti.static(kUseQuadrupole):
+                        if use_quadrupole[None]:
+                            acc += quadrupole_gravity_func(
+                                distance, node_quadrupole[child])
                 else:
-                    new_trash_id = alloc_trash()
-                    child_geo_size = parent_geo_size * 0.5
-                    trash_base_parent[new_trash_id] = child
-                    trash_base_geo_size[new_trash_id] = child_geo_size
-
-        trash_id = trash_id + 1
+                    assert stack_len < kStackSize
+                    stack_node[lane, stack_len] = child
+                    stack_geo_size[lane, stack_len] = child_geo_size
+                    stack_len = stack_len + 1
 
     return acc
 
 
+@ti.func
+def get_tree_potential_at(position, self_id, lane):
+    # same walk as get_tree_gravity_at, summing potentials instead
+    pot = 0.0
+    theta2 = opening_angle[None]**2
+
+    stack_node[lane, 0] = 0
+    stack_geo_size[lane, 0] = 1.0
+    stack_len = 1
+
+    while stack_len > 0:
+        stack_len = stack_len - 1
+        parent = stack_node[lane, stack_len]
+        parent_geo_size = stack_geo_size[lane, stack_len]
+
+        if node_particle_id[parent] >= 0:
+            for k in range(node_begin[parent], node_end[parent]):
+                particle_id = sort_id[k]
+                if particle_id != self_id:
+                    distance = particle_pos[particle_id] - position
+                    pot -= particle_mass[particle_id] * ti.rsqrt(
+                        distance.norm_sqr() + kSoftening)
+
+        else:  # TREE or LEAF
+            for which in ti.grouped(ti.ndrange(*kChildShape)):
+                child = node_children[parent, which]
+                if child == LEAF:
+                    continue
+                node_center = node_weighted_pos[child] / node_mass[child]
+                distance = node_center - position
+                child_geo_size = parent_geo_size * 0.5
+                if distance.norm_sqr() * theta2 > child_geo_size**2:
+                    r2 = distance.norm_sqr() + kSoftening
+                    pot -= node_mass[child] * ti.rsqrt(r2)
+                    if ti.static(kUseQuadrupole):
+                        if use_quadrupole[None]:
+                            pot -= 0.5 * distance.dot(
+                                node_quadrupole[child] @ distance) * r2**-2.5
+                else:
+                    assert stack_len < kStackSize
+                    stack_node[lane, stack_len] = child
+                    stack_geo_size[lane, stack_len] = child_geo_size
+                    stack_len = stack_len + 1
+
+    return pot
+
+
 @ti.func
 def get_raw_gravity_at(pos):
     acc = particle_pos[0] * 0
@@ -225,26 +819,152 @@ def substep_raw():
 
 
 @ti.kernel
-def substep_tree():
-    particle_id = 0
-    while particle_id < particle_table_len[None]:
-        acceleration = get_tree_gravity_at(particle_pos[particle_id])
+def kick_tree(base: ti.i32):
+    for lane in range(min(kStackLanes, particle_table_len[None] - base)):
+        particle_id = base + lane
+        acceleration = get_tree_gravity_at(particle_pos[particle_id], lane)
         particle_vel[particle_id] += acceleration * dt
         # well... seems our tree inserter will break if particle out-of-bound:
         particle_vel[particle_id] = tl.boundReflect(particle_pos[particle_id],
                                                     particle_vel[particle_id],
                                                     0, 1)
-        particle_id = particle_id + 1
+
+
+@ti.kernel
+def compute_energies(base: ti.i32):
+    for lane in range(min(kStackLanes, particle_table_len[None] - base)):
+        particle_id = base + lane
+        pot = get_tree_potential_at(particle_pos[particle_id], particle_id,
+                                    lane)
+        vel = particle_vel[particle_id]
+        if ti.static(kBlockTimesteps):
+            # substep_block leaves the opening half kick applied; undo it
+            # so the kinetic term is at the same time as the positions
+            bin_id = particle_bin[particle_id]
+            if bin_id >= 0:
+                vel -= particle_acc[particle_id] * (
+                    0.5 * kMaxTimestep / (1 << bin_id))
+        particle_energy[particle_id] = particle_mass[particle_id] * 0.5 * (
+            vel.norm_sqr() + pot)
+
+
+def total_energy():
+    # costs about one force evaluation instead of an O(N^2) pair sum
+    build_tree()
+    for base in range(0, particle_table_len[None], kStackLanes):
+        compute_energies(base)
+    count = particle_table_len[None]
+    return particle_energy.to_numpy()[:count].sum(dtype=np.float64)
+
+
+@ti.kernel
+def drift():
     for i in range(particle_table_len[None]):
         particle_pos[i] += particle_vel[i] * dt
 
 
+def substep_tree():
+    for base in range(0, particle_table_len[None], kStackLanes):
+        kick_tree(base)
+    drift()
+
+
+@ti.kernel
+def collect_active(step: ti.i32):
+    active_len[None] = 0
+    for i in range(particle_table_len[None]):
+        bin_id = particle_bin[i]
+        if (bin_id < 0) | (step % (1 << (kMaxBin - max(bin_id, 0))) == 0):
+            active_list[ti.atomic_add(active_len[None], 1)] = i
+
+
+@ti.kernel
+def kick_active(base: ti.i32, step: ti.i32):
+    # the closing half kick of the old step and the opening half kick of
+    # the new one share the force evaluated now, at the step boundary
+    for lane in range(min(kStackLanes, active_len[None] - base)):
+        particle_id = active_list[base + lane]
+        acceleration = get_tree_gravity_at(particle_pos[particle_id], lane)
+
+        old_dt = 0.0
+        if particle_bin[particle_id] >= 0:
+            old_dt = kMaxTimestep / (1 << particle_bin[particle_id])
+
+        # may only move to a bigger step at a boundary of that bin
+        new_bin = 0
+        while new_bin < kMaxBin:
+            if step % (1 << (kMaxBin - new_bin)) == 0:
+                break
+            new_bin = new_bin + 1
+        wanted_dt = kTimestepAccuracy * ti.sqrt(
+            kSoftening**0.5 / (acceleration.norm() + 1e-30))
+        while new_bin < kMaxBin:
+            if kMaxTimestep / (1 << new_bin) <= wanted_dt:
+                break
+            new_bin = new_bin + 1
+        new_dt = kMaxTimestep / (1 << new_bin)
+
+        particle_vel[particle_id] += acceleration * (0.5 * (old_dt + new_dt))
+        particle_acc[particle_id] = acceleration
+        particle_bin[particle_id] = new_bin
+        particle_vel[particle_id] = tl.boundReflect(particle_pos[particle_id],
+                                                    particle_vel[particle_id],
+                                                    0, 1)
+
+
+@ti.kernel
+def find_deepest_bin():
+    deepest_bin[None] = 0
+    for i in range(particle_table_len[None]):
+        ti.atomic_max(deepest_bin[None], particle_bin[i])
+
+
+@ti.kernel
+def drift_by(h: ti.f32):
+    for i in range(particle_table_len[None]):
+        particle_pos[i] += particle_vel[i] * h
+
+
+force_evaluations = 0
+
+
+def substep_block():
+    # advance everything by kMaxTimestep with KDK leapfrog; a particle in
+    # bin b gets its force evaluated every 2**(kMaxBin - b) fine steps, and
+    # fine steps with no bin boundary in them are drifted over in one go
+    global force_evaluations
+    force_evaluations = 0
+    step = 0
+    while step < 2**kMaxBin:
+        collect_active(step)
+        if active_len[None]:
+            # the rebuild may reorder the particles or reallocate the
+            # tables, so the list it kicks is taken again afterwards
+            update_tree()
+            collect_active(step)
+            for base in range(0, active_len[None], kStackLanes):
+                kick_active(base, step)
+            force_evaluations += active_len[None]
+        find_deepest_bin()
+        stride = 2**(kMaxBin - deepest_bin[None])
+        drift_by(stride * kMinTimestep)
+        step += stride
+
+
+def advance():
+    if kBlockTimesteps:
+        substep_block()
+    else:
+        update_tree()
+        substep_tree()
+
+
 @ti.kernel
 def render_arrows(mx: ti.f32, my: ti.f32):
     pos = tl.vec(mx, my)
     acc = get_raw_gravity_at(pos) * 0.001
     tl.paintArrow(display_image, pos, acc, tl.D.yyx)
-    acc_tree = get_tree_gravity_at(pos) * 0.001
+    acc_tree = get_tree_gravity_at(pos, 0) * 0.001
     tl.paintArrow(display_image, pos, acc_tree, tl.D.yxy)
 
 
@@ -252,7 +972,7 @@ def render_arrows(mx: ti.f32, my: ti.f32):
 def render_pixels():
     for i in range(particle_table_len[None]):
         position = particle_pos[i]
-        pix = int(position * kResolution)
+        pix = int(tl.vec(position.x, position.y) * kResolution)
         display_image[tl.clamp(pix, 0, kResolution - 1)] += 0.25
 
 
@@ -276,39 +996,326 @@ def render_tree(gui,
         render_tree(gui, child, child_geo_center, child_geo_size)
 
 
+def time_it(func, repeat=3):
+    func()  # warm up, includes JIT compilation
+    ti.sync()
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        ti.sync()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def benchmark_build(sizes=(8192, 65536, 2**20)):
+    print('|------------|-----------|-----------|---------|')
+    print('| particles  | serial    | parallel  | speedup |')
+    print('|------------|-----------|-----------|---------|')
+    for n in sizes:
+        particle_table_len[None] = 0
+        reserve_particles(n)
+        add_random_particles_n(n)
+        t_serial = time_it(build_tree_serial)
+        mass_serial = node_mass[0]
+        t_parallel = time_it(build_tree_parallel)
+        mass_parallel = node_mass[0]
+        assert abs(mass_serial - mass_parallel) <= 1e-3 * abs(mass_serial)
+        print(f'| {n:10d} | {t_serial * 1e3:6.1f} ms | '
+              f'{t_parallel * 1e3:6.1f} ms | {t_serial / t_parallel:6.2f}x |')
+    print('|------------|-----------|-----------|---------|')
+
+
+def benchmark_force(n=65536):
+    particle_table_len[None] = 0
+    reserve_particles(n)
+    add_random_particles_n(n)
+    build_tree()
+
+    def force_pass():
+        for base in range(0, particle_table_len[None], kStackLanes):
+            kick_tree(base)
+
+    print(f'force: {time_it(force_pass) * 1e3:.2f} ms')
+
+
+def benchmark_bucket(n=65536, buckets=(1, 2, 4, 8, 16, 32, 64)):
+    particle_table_len[None] = 0
+    reserve_particles(n)
+    add_random_particles_n(n)
+
+    def force_pass():
+        for base in range(0, particle_table_len[None], kStackLanes):
+            kick_tree(base)
+
+    print('|--------|-----------|-----------|-----------|-----------|')
+    print('| bucket | nodes     | build     | force     | total     |')
+    print('|--------|-----------|-----------|-----------|-----------|')
+    for bucket in buckets:
+        leaf_capacity[None] = bucket
+        t_build = time_it(build_tree_parallel)
+        t_force = time_it(force_pass)
+        print(f'| {bucket:6d} | {node_table_len[None]:9d} | '
+              f'{t_build * 1e3:6.2f} ms | {t_force * 1e3:6.2f} ms | '
+              f'{(t_build + t_force) * 1e3:6.2f} ms |')
+    print('|--------|-----------|-----------|-----------|-----------|')
+    leaf_capacity[None] = kLeafCapacity
+
+
+def benchmark_reorder(n=65536):
+    particle_table_len[None] = 0
+    reserve_particles(n)
+    add_random_particles_n(n)
+
+    def force_pass():
+        for base in range(0, particle_table_len[None], kStackLanes):
+            kick_tree(base)
+
+    build_tree_parallel()
+    t_unsorted = time_it(force_pass)
+    reorder_particles()
+    t_sorted = time_it(force_pass)
+    print('|-----------|-----------|')
+    print('| order     | force     |')
+    print('|-----------|-----------|')
+    print(f'| insertion | {t_unsorted * 1e3:6.2f} ms |')
+    print(f'| morton    | {t_sorted * 1e3:6.2f} ms |')
+    print('|-----------|-----------|')
+    print(f'speedup: {t_unsorted / t_sorted:.2f}x')
+
+
+@ti.kernel
+def add_plummer_particles(num: ti.i32, radius: ti.f32):
+    for i in range(num):
+        particle_id = alloc_particle()
+        # inverse of the Plummer cumulative mass profile, clipped at 10 radii
+        u = tl.randRange(1e-3, 1.0)
+        r = min(radius / ti.sqrt(u**(-2 / 3) - 1), 10 * radius)
+        direction = particle_pos[0] * 0
+        if ti.static(kDim == 2):
+            direction = tl.randUnit2D()
+        else:
+            direction = tl.randUnit3D()
+        particle_pos[particle_id] = direction * r + 0.5
+        particle_mass[particle_id] = 1.0 / num
+
+
+def benchmark_scene(n, steps=10):
+    particle_table_len[None] = 0
+    reserve_particles(n)
+    add_plummer_particles(n, 0.04)
+    build_tree()
+    ti.sync()
+
+    t_build = time_it(build_tree)
+    t0 = time.perf_counter()
+    for i in range(steps):
+        advance()
+    ti.sync()
+    t_step = (time.perf_counter() - t0) / steps
+    print(f'{kDim}D Plummer sphere, {n} particles, {node_table_len[None]} nodes')
+    print(f'build: {t_build * 1e3:.2f} ms')
+    print(f'step:  {t_step * 1e3:.2f} ms')
+    if kBlockTimesteps:
+        print(f'force evaluations per step: {force_evaluations} '
+              f'({force_evaluations / (n * 2**kMaxBin):.2%} of shared dt)')
+
+
+@ti.kernel
+def add_uniform_particles(num: ti.i32):
+    for i in range(num):
+        particle_id = alloc_particle()
+        particle_pos[particle_id] = tl.randND(kDim) * 0.8 + 0.1
+        particle_mass[particle_id] = tl.randRange(0.0, 1.5)
+
+
+def save_snapshot(path):
+    # ordered by external id, so snapshots line up across reorders
+    count = particle_table_len[None]
+    slot = particle_slot.to_numpy()[:count]
+    np.savez(path,
+             pos=particle_pos.to_numpy()[slot],
+             vel=particle_vel.to_numpy()[slot],
+             mass=particle_mass.to_numpy()[slot])
+
+
+def run_headless(n, distribution, steps, snapshot_every, output):
+    particle_table_len[None] = 0
+    reserve_particles(n)
+    if distribution == 'disk':
+        add_random_particles_n(n)
+    elif distribution == 'uniform':
+        add_uniform_particles(n)
+    else:
+        add_plummer_particles(n, 0.04)
+    if snapshot_every:
+        os.makedirs(output, exist_ok=True)
+        save_snapshot(os.path.join(output, 'snapshot_000000.npz'))
+    energy0 = total_energy()
+
+    t_snapshot = 0.0
+    t0 = time.perf_counter()
+    for step in range(1, steps + 1):
+        if kUseTree:
+            advance()
+        else:
+            substep_raw()
+        if snapshot_every and step % snapshot_every == 0:
+            ti.sync()
+            t1 = time.perf_counter()
+            save_snapshot(os.path.join(output, f'snapshot_{step:06d}.npz'))
+            drift_e = total_energy() / energy0 - 1
+            t_snapshot += time.perf_counter() - t1
+            print(f'step {step}/{steps}: '
+                  f'{step / (time.perf_counter() - t0 - t_snapshot):.2f} '
+                  f'steps/sec, energy drift {drift_e:.2e}')
+    ti.sync()
+    elapsed = time.perf_counter() - t0 - t_snapshot
+    print(f'{n} particles, {steps} steps in {elapsed:.2f} s: '
+          f'{steps / elapsed:.2f} steps/sec, '
+          f'energy drift {total_energy() / energy0 - 1:.2e}')
+
+
+def benchmark_threads():
+    max_threads = os.cpu_count() or 1
+    threads = [1]
+    while threads[-1] * 2 <= max_threads:
+        threads.append(threads[-1] * 2)
+    if threads[-1] != max_threads:
+        threads.append(max_threads)
+
+    print('|---------|-----------|---------|')
+    print('| threads | force     | speedup |')
+    print('|---------|-----------|---------|')
+    t_single = None
+    for n in threads:
+        out = subprocess.run([
+            sys.executable, __file__, '--bench-force', '--threads', str(n)
+        ], check=True, capture_output=True, text=True).stdout
+        t = float(out.split('force:')[-1].split()[0])
+        t_single = t_single or t
+        print(f'| {n:7d} | {t:6.2f} ms | {t_single / t:6.2f}x |')
+    print('|---------|-----------|---------|')
+
+
+@ti.kernel
+def measure_force_error(stride: ti.i32):
+    for k in range(kAccuracySamples):
+        i = k * stride
+        accuracy_error[k] = -1.0
+        if i < particle_table_len[None]:
+            exact = get_raw_gravity_at(particle_pos[i])
+            approx = get_tree_gravity_at(particle_pos[i], k)
+            accuracy_error[k] = (approx - exact).norm_sqr() / (
+                exact.norm_sqr() + 1e-30)
+
+
+def accuracy_report(n=65536, angles=(0.2, 0.3, 0.5, 0.7, 1.0)):
+    particle_table_len[None] = 0
+    reserve_particles(n)
+    add_random_particles_n(n)
+    stride = max(1, n // kAccuracySamples)
+
+    def step():
+        build_tree()
+        for base in range(0, particle_table_len[None], kStackLanes):
+            kick_tree(base)
+
+    print('|-------|------------|-----------|-----------|')
+    print('| theta | multipole  | rms error | step      |')
+    print('|-------|------------|-----------|-----------|')
+    for theta in angles:
+        for quadrupole in [0, 1] if kUseQuadrupole else [0]:
+            opening_angle[None] = theta
+            use_quadrupole[None] = quadrupole
+            t = time_it(step)
+            measure_force_error(stride)
+            err = [e for e in accuracy_error.to_numpy() if e >= 0]
+            rms = (sum(err) / len(err))**0.5
+            kind = 'quadrupole' if quadrupole else 'monopole'
+            print(f'| {theta:5.2f} | {kind:10s} | {rms:9.2e} | '
+                  f'{t * 1e3:6.2f} ms |')
+    print('|-------|------------|-----------|-----------|')
+    opening_angle[None] = kOpeningAngle
+    use_quadrupole[None] = kUseQuadrupole
+
+
+opening_angle[None] = kOpeningAngle
+use_quadrupole[None] = kUseQuadrupole
+leaf_capacity[None] = kLeafCapacity
+
+if args.accuracy:
+    accuracy_report()
+    raise SystemExit
+if args.bench_build:
+    benchmark_build()
+    raise SystemExit
+if args.bench_force:
+    benchmark_force()
+    raise SystemExit
+if args.bench_threads:
+    benchmark_threads()
+    raise SystemExit
+if args.bench_bucket:
+    benchmark_bucket()
+    raise SystemExit
+if args.bench_reorder:
+    benchmark_reorder()
+    raise SystemExit
+if args.bench_scene:
+    benchmark_scene(args.particles)
+    raise SystemExit
+if args.headless:
+    run_headless(args.particles, args.distribution, args.steps,
+                 args.snapshot_every, args.output)
+    raise SystemExit
+
 print('[Hint] Press `r` to add 512 random particles')
 print('[Hint] Drag with mouse left button to add a series of particles')
 print('[Hint] Drag with mouse middle button to add zero-mass particles')
 print('[Hint] Click mouse right button to add a single particle')
+print('[Hint] Press `c` to remove all particles')
+print('[Hint] Press `[` and `]` to shrink or grow the opening angle')
+print('[Hint] Press `q` to toggle quadrupole moments')
 gui = ti.GUI('Tree-code', kResolution)
 while gui.running:
     for e in gui.get_events(gui.PRESS):
         if e.key == gui.ESCAPE:
             gui.running = False
         elif e.key == gui.RMB:
+            reserve_particles(particle_table_len[None] + 1)
             add_particle_at(*gui.get_cursor_pos(), 1.0)
         elif e.key == 'r':
-            if particle_table_len[None] + 512 < kMaxParticles:
-                for i in range(512):
-                    add_random_particles()
+            reserve_particles(particle_table_len[None] + 512)
+            for i in range(512):
+                add_random_particles()
+        elif e.key == 'c':
+            particle_table_len[None] = 0
+            shrink_tables()
+        elif e.key in '[]':
+            opening_angle[None] *= 1.25 if e.key == ']' else 0.8
+            print('opening angle:', opening_angle[None])
+        elif e.key == 'q' and kUseQuadrupole:
+            use_quadrupole[None] = not use_quadrupole[None]
+            print('quadrupole:', bool(use_quadrupole[None]))
     if gui.is_pressed(gui.MMB, gui.LMB):
+        reserve_particles(particle_table_len[None] + 1)
         add_particle_at(*gui.get_cursor_pos(), gui.is_pressed(gui.LMB))
 
     if kUseTree:
-        build_tree()
-        substep_tree()
+        advance()
     else:
         substep_raw()
     if len(kDisplay) and 'trace' not in kDisplay:
         display_image.fill(0)
-    if 'mouse' in kDisplay:
+    if 'mouse' in kDisplay and kDim == 2:
         render_arrows(*gui.get_cursor_pos())
     if 'pixels' in kDisplay:
         render_pixels()
     if len(kDisplay):
         gui.set_image(display_image)
-    if 'tree' in kDisplay:
+    if 'tree' in kDisplay and kDim == 2:
         render_tree(gui)
     if 'pixels' not in kDisplay:
-        gui.circles(particle_pos.to_numpy()[:particle_table_len[None]])
+        gui.circles(particle_pos.to_numpy()[:particle_table_len[None], :2])
     gui.show()
@@ -1,5 +1,6 @@
 import taichi as ti
 import taichi_glsl as tl
+import tables
 import random, math
 ti.init()#kernel_profiler=True)
 
@@ -10,7 +11,7 @@ gamma = 7
 c_0 = 20.0
 rho_0 = 1000.0
 m0 = dx**2 * 100
-kMaxParticles = 1024
+kMinParticles = 1024
 kResolution = 512
 
 kBackgroundColor = 0x112f41
@@ -18,14 +19,31 @@ kParticleColor = 0x068587
 kBoundaryColor = 0xebaca2
 kParticleSize = 5
 
-pos = ti.Vector(2, ti.f32, kMaxParticles)
-vel = ti.Vector(2, ti.f32, kMaxParticles)
-pressure = ti.var(ti.f32, kMaxParticles)
-density = ti.var(ti.f32, kMaxParticles)
-d_vel = ti.Vector(2, ti.f32, kMaxParticles)
-d_pressure = ti.var(ti.f32, kMaxParticles)
-d_density = ti.var(ti.f32, kMaxParticles)
-num = ti.var(ti.i32, ())
+
+def allocate_particles(capacity):
+    global kMaxParticles, pos, vel, pressure, density
+    global d_vel, d_pressure, d_density, num
+    kMaxParticles = capacity
+    pos = ti.Vector(2, ti.f32, kMaxParticles)
+    vel = ti.Vector(2, ti.f32, kMaxParticles)
+    pressure = ti.var(ti.f32, kMaxParticles)
+    density = ti.var(ti.f32, kMaxParticles)
+    d_vel = ti.Vector(2, ti.f32, kMaxParticles)
+    d_pressure = ti.var(ti.f32, kMaxParticles)
+    d_density = ti.var(ti.f32, kMaxParticles)
+    num = ti.var(ti.i32, ())
+    return pos, vel, pressure, density
+
+
+def resize_particles(capacity):
+    count = num[None]
+    if capacity != kMaxParticles:
+        tables.reallocate(capacity, count, (pos, vel, pressure, density),
+                          allocate_particles)
+        num[None] = count
+
+
+allocate_particles(kMinParticles)
 
 
 @ti.func
@@ -123,10 +141,16 @@ while gui.running:
             else:
                 mouse = tl.vec(*gui.get_cursor_pos())
                 diff = (mouse - last_mouse) * 2.0
+                resize_particles(tables.grow(kMaxParticles, num[None] + 1))
                 add_particle_at(mouse.x, mouse.y, diff.x, diff.y)
         elif e.type == gui.PRESS and e.key == 'r':
                 a = random.random() * math.tau
+                resize_particles(tables.grow(kMaxParticles, num[None] + 1))
                 add_particle_at(math.cos(a) * 0.4 + 0.5, math.sin(a) * 0.4 + 0.5, 0, 0)
+        elif e.type == gui.PRESS and e.key == 'c':
+                num[None] = 0
+                resize_particles(
+                    tables.shrink(kMaxParticles, num[None], kMinParticles))
 
     substep()
     gui.circles(pos.to_numpy()[:num[None]],